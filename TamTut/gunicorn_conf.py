@@ -0,0 +1,62 @@
+"""
+gunicorn settings, used with `gunicorn -c python:TamTut.gunicorn_conf TamTut.wsgi:application`.
+
+Each worker runs GUNICORN_THREADS threads, and each thread holds at most one
+database connection during a request. So with DB_CONNECTION_MODE=pooled,
+DB_POOL_SIZE should be at least the thread count, and workers * DB_POOL_SIZE
+must stay below max_connections of PostgreSQL.
+
+Up to LONG_POLL_MAX_WAITERS threads per worker are held by long polls for new
+messages. They give their connection back between checks, but not the thread,
+so by default every worker gets that many threads on top of the 4 serving
+ordinary requests.
+"""
+import multiprocessing
+
+from decouple import config
+
+from TamTut.settings import LONG_POLL_MAX_WAITERS
+
+bind = config('GUNICORN_BIND', default='0.0.0.0:8000')
+workers = config('GUNICORN_WORKERS', default=multiprocessing.cpu_count() * 2 + 1, cast=int)
+worker_class = 'gthread'
+threads = config('GUNICORN_THREADS', default=4 + LONG_POLL_MAX_WAITERS, cast=int)
+
+# the app is imported once in the master and shared copy-on-write by the workers
+preload_app = True
+# workers are recycled after this many requests, jittered so they don't all restart at once
+max_requests = config('GUNICORN_MAX_REQUESTS', default=1000, cast=int)
+max_requests_jitter = max_requests // 10
+
+timeout = 30
+graceful_timeout = 30
+# nginx keeps its upstream connections open
+keepalive = 5
+
+
+def pre_fork(server, worker):
+    # a connection opened in the master while preloading must not be shared by the forked workers
+    from django.db import connections
+    from core.db_pool.pool import close_pools
+
+    connections.close_all()
+    close_pools()
+
+
+def post_fork(server, worker):
+    from core.metrics import worker_totals
+
+    worker_totals.start()
+
+
+def worker_exit(server, worker):
+    # the totals counted since the last periodic write
+    from core.metrics import worker_totals
+
+    worker_totals.flush()
+
+
+def child_exit(server, worker):
+    from core.metrics import worker_totals
+
+    worker_totals.fold(worker.pid)
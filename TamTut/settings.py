@@ -28,6 +28,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'core.metrics.RequestMetricsMiddleware',
+    'core.routers.ReplicaRoutingMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -35,13 +37,14 @@ MIDDLEWARE = [
     'django.contrib.auth.middleware.AuthenticationMiddleware',
     'django.contrib.messages.middleware.MessageMiddleware',
     'django.middleware.clickjacking.XFrameOptionsMiddleware',
+    'core.profiling.ProfilingMiddleware',
 ]
 
 ROOT_URLCONF = 'TamTut.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        'BACKEND': 'core.metrics.DjangoTemplates',
         'DIRS': [os.path.join(BASE_DIR, 'templates')],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -68,6 +71,48 @@ DATABASES = {
     }
 }
 
+# database connections: 'fresh' opens one per request, 'persistent' keeps it open for DB_CONN_MAX_AGE seconds,
+# 'pooled' checks it out of a per-process pool of DB_POOL_SIZE connections, see core.db_pool; a checkout waits up
+# to DB_POOL_TIMEOUT seconds, connections idle for DB_POOL_CHECK_AFTER seconds are pinged first and
+# ones older than DB_POOL_MAX_AGE seconds are replaced; the default size is one per default gunicorn thread
+DB_CONNECTION_MODE = config('DB_CONNECTION_MODE', default='persistent')
+DB_CONN_MAX_AGE = config('DB_CONN_MAX_AGE', default=60, cast=int)
+DB_POOL_SIZE = config('DB_POOL_SIZE', default=6, cast=int)
+DB_POOL_TIMEOUT = config('DB_POOL_TIMEOUT', default=5, cast=float)
+DB_POOL_CHECK_AFTER = config('DB_POOL_CHECK_AFTER', default=30, cast=float)
+DB_POOL_MAX_AGE = config('DB_POOL_MAX_AGE', default=3600, cast=float)
+if DB_CONNECTION_MODE == 'persistent':
+    DATABASES['default']['CONN_MAX_AGE'] = DB_CONN_MAX_AGE
+elif DB_CONNECTION_MODE == 'pooled':
+    DATABASES['default']['ENGINE'] = 'core.db_pool'
+
+# optional read replica, see core.routers: read-only requests use it, except for REPLICA_PIN_SECONDS after a user wrote;
+# in tests it mirrors the default database
+REPLICA_HOST = config('REPLICA_HOST', default='')
+if REPLICA_HOST:
+    DATABASES['replica'] = dict(DATABASES['default'], HOST=REPLICA_HOST,
+                                PORT=config('REPLICA_PORT', default=DATABASES['default']['PORT']),
+                                TEST={'MIRROR': 'default'})
+DATABASE_ROUTERS = ['core.routers.PrimaryReplicaRouter']
+REPLICA_PIN_SECONDS = config('REPLICA_PIN_SECONDS', default=10, cast=float)
+
+# Shared (L2) cache, the in-process LRU in front of it is configured below, see core.cache.
+# The file based default culls a third of the entries once it holds CACHE_MAX_ENTRIES, and lists the whole
+# directory on every write to find out; past a single host point CACHE_BACKEND to memcached instead.
+# Tests run against an in-process cache, see TamTut.test_runner
+
+CACHES = {
+    'default': {
+        'BACKEND': config('CACHE_BACKEND', default='django.core.cache.backends.filebased.FileBasedCache'),
+        'LOCATION': config('CACHE_LOCATION', default='/var/tmp/tamtut_cache'),
+        'TIMEOUT': config('CACHE_TIMEOUT', default=3600, cast=int),
+        'OPTIONS': {
+            'MAX_ENTRIES': config('CACHE_MAX_ENTRIES', default=50000, cast=int),
+        },
+    }
+}
+TEST_RUNNER = 'TamTut.test_runner.TestRunner'
+
 # Password validation
 # https://docs.djangoproject.com/en/2.2/ref/settings/#auth-password-validators
 
@@ -106,8 +151,98 @@ STATIC_URL = '/static/'
 
 MEDIA_URL = '/media/'
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
+# uploads are named by their content hash, see core.storage
+DEFAULT_FILE_STORAGE = 'core.storage.ContentHashStorage'
 
 POSTS_ON_PROFILE_PAGE = config('POSTS_ON_PROFILE_PAGE', default=10)
 POSTS_ON_HOME_PAGE = config('POSTS_ON_HOME_PAGE', default=20)
-DAYS_HOT_POSTS = config('DAYS_HOT_POSTS', default=3)
+# seconds of age that outweigh a tenfold increase in likes in the hot feed ranking
+HOT_SCORE_DECAY_SECONDS = config('HOT_SCORE_DECAY_SECONDS', default=45000, cast=int)
 FOLLOWERS_ON_FOLLOWS_PAGE = config('FOLLOWERS_ON_FOLLOWS_PAGE', default=40)
+CONVERSATIONS_ON_CHAT_PAGE = config('CONVERSATIONS_ON_CHAT_PAGE', default=30)
+MESSAGES_ON_CHAT_PAGE = config('MESSAGES_ON_CHAT_PAGE', default=50)
+# seconds a new messages request is held open, and how often it re-checks the database meanwhile;
+# at most LONG_POLL_MAX_WAITERS of them are held per process, GUNICORN_THREADS leaves 4 threads besides them
+LONG_POLL_TIMEOUT = config('LONG_POLL_TIMEOUT', default=25, cast=float)
+LONG_POLL_INTERVAL = config('LONG_POLL_INTERVAL', default=2, cast=float)
+LONG_POLL_MAX_WAITERS = config('LONG_POLL_MAX_WAITERS', default=2, cast=int)
+
+# authors with more followers than this are not fanned out on write, their posts are merged into the feed on read
+FANOUT_FOLLOWERS_LIMIT = config('FANOUT_FOLLOWERS_LIMIT', default=1000, cast=int)
+# how many of the latest posts of a profile are copied into a timeline when following it
+TIMELINE_BACKFILL_POSTS = config('TIMELINE_BACKFILL_POSTS', default=200, cast=int)
+
+# size of the map grid cells profiles are bucketed into, the cap of markers returned for one viewport and
+# the profiles listed under the map; the stored cells depend on MAP_GRID_DEGREES, so after changing it
+# run `python manage.py recompute_geo_cells`
+MAP_GRID_DEGREES = config('MAP_GRID_DEGREES', default=0.05, cast=float)
+MAP_MARKERS_LIMIT = config('MAP_MARKERS_LIMIT', default=500, cast=int)
+PROFILES_ON_MAP_PAGE = config('PROFILES_ON_MAP_PAGE', default=50, cast=int)
+
+# nearby people ranking on the map: distance at which a shared hobby counts half, profiles shown, snapshot reload period
+NEARBY_DISTANCE_SCALE_KM = config('NEARBY_DISTANCE_SCALE_KM', default=5, cast=float)
+NEARBY_PROFILES_ON_MAP = config('NEARBY_PROFILES_ON_MAP', default=50, cast=int)
+NEARBY_SNAPSHOT_TTL = config('NEARBY_SNAPSHOT_TTL', default=300, cast=float)
+
+# how many most similar people by hobbies are kept for every profile; after a hobby change the other lists are
+# updated on a thread pool (0 is inline), recomputing at most SIMILAR_REFRESH_HOLDERS_LIMIT lists it dropped out of
+SIMILAR_PROFILES_COUNT = config('SIMILAR_PROFILES_COUNT', default=10, cast=int)
+SIMILARITY_WORKERS = config('SIMILARITY_WORKERS', default=1, cast=int)
+SIMILAR_REFRESH_HOLDERS_LIMIT = config('SIMILAR_REFRESH_HOLDERS_LIMIT', default=100, cast=int)
+
+# "who to follow": suggestions kept for every profile, and what a shared hobby is worth next to a mutual follow
+SUGGESTED_PROFILES_COUNT = config('SUGGESTED_PROFILES_COUNT', default=10, cast=int)
+SUGGESTION_HOBBY_WEIGHT = config('SUGGESTION_HOBBY_WEIGHT', default=0.5, cast=float)
+
+# answer the map hobby search from an in-process inverted index, rebuilt in every worker on hobby changes
+# (noticed within CACHE_VERSION_L1_TIMEOUT) or every HOBBY_INDEX_TTL seconds
+HOBBY_INDEX_ENABLED = config('HOBBY_INDEX_ENABLED', default=False, cast=bool)
+HOBBY_INDEX_TTL = config('HOBBY_INDEX_TTL', default=600, cast=float)
+
+# square bounding boxes of the generated image variants, and the size of the thread pool generating them (0 is inline)
+IMAGE_VARIANT_SIZES = (40, 100, 300)
+IMAGE_PROCESSING_WORKERS = config('IMAGE_PROCESSING_WORKERS', default=2, cast=int)
+
+# in-process L1 cache: max entries, seconds an entry is kept, seconds a looked up object version is trusted
+CACHE_L1_MAX_ENTRIES = config('CACHE_L1_MAX_ENTRIES', default=10000, cast=int)
+CACHE_L1_TIMEOUT = config('CACHE_L1_TIMEOUT', default=60, cast=float)
+CACHE_VERSION_L1_TIMEOUT = config('CACHE_VERSION_L1_TIMEOUT', default=2, cast=float)
+
+# seconds a rendered template fragment is kept, it is dropped earlier once the objects it shows change
+FRAGMENT_CACHE_TIMEOUT = config('FRAGMENT_CACHE_TIMEOUT', default=3600, cast=int)
+
+# share of requests measured by core.metrics (0 disables it), latency histogram buckets in seconds,
+# whether every measured request is also logged as a JSON line, and the bearer token of the metrics endpoint
+METRICS_SAMPLE_RATE = config('METRICS_SAMPLE_RATE', default=0, cast=float)
+METRICS_LATENCY_BUCKETS = (0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+METRICS_LOG = config('METRICS_LOG', default=False, cast=bool)
+METRICS_TOKEN = config('METRICS_TOKEN', default='')
+
+# directory where every gunicorn worker writes its metrics totals every METRICS_FLUSH_INTERVAL seconds, so the
+# metrics endpoint answers for all workers; empty to only count the worker serving the scrape
+METRICS_DIR = config('METRICS_DIR', default='/var/tmp/tamtut_metrics')
+METRICS_FLUSH_INTERVAL = config('METRICS_FLUSH_INTERVAL', default=10, cast=float)
+
+# request profiling by core.profiling: staff trigger it with the X-Profile header or ?profile, a PROFILING_SAMPLE_RATE
+# share of all requests is profiled too; the newest PROFILING_KEEP profiles are kept in PROFILING_DIR
+PROFILING_ENABLED = config('PROFILING_ENABLED', default=True, cast=bool)
+PROFILING_SAMPLE_RATE = config('PROFILING_SAMPLE_RATE', default=0, cast=float)
+PROFILING_DIR = config('PROFILING_DIR', default=os.path.join(BASE_DIR, 'profiles'))
+PROFILING_KEEP = config('PROFILING_KEEP', default=200, cast=int)
+
+LOGGING = {
+    'version': 1,
+    'disable_existing_loggers': False,
+    'handlers': {
+        'console': {
+            'class': 'logging.StreamHandler',
+        },
+    },
+    'loggers': {
+        'core.metrics': {
+            'handlers': ['console'],
+            'level': 'INFO',
+            'propagate': False,
+        },
+    },
+}
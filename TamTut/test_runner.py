@@ -0,0 +1,25 @@
+from unittest import mock
+
+from django.test.runner import DiscoverRunner
+from django.test.utils import override_settings
+
+
+class TestRunner(DiscoverRunner):
+    """
+    Runs the tests against an in-process cache, as they clear it, and counts
+    metrics of the test process only rather than adding them to the workers' totals.
+    """
+
+    def setup_test_environment(self, **kwargs):
+        super().setup_test_environment(**kwargs)
+        self.cache_settings = override_settings(CACHES={
+            'default': {'BACKEND': 'django.core.cache.backends.locmem.LocMemCache'},
+        })
+        self.cache_settings.enable()
+        self.metrics_dir = mock.patch('core.metrics.worker_totals.directory', '')
+        self.metrics_dir.start()
+
+    def teardown_test_environment(self, **kwargs):
+        self.metrics_dir.stop()
+        self.cache_settings.disable()
+        super().teardown_test_environment(**kwargs)
@@ -0,0 +1,102 @@
+import statistics
+import time
+import tracemalloc
+
+from django.contrib.auth.models import User
+from django.db import connection
+from django.test import Client
+from django.test.utils import override_settings
+from django.urls import reverse
+
+from core.enums import FeedSorting
+from core.metrics import QueryCounter
+from core.models import Conversation, Post, Profile
+
+
+def benchmark_user():
+    """The user following the most profiles, whose followers feed is the heaviest to build, in a group chat if any."""
+    profiles = Profile.objects.select_related('user').order_by('-following_count', 'id')
+    return getattr(profiles.filter(user__inside_group_chats__isnull=False).first() or profiles.first(), 'user', None)
+
+
+def view_urls(user):
+    """(name, url) of every benchmarked view as seen by `user`, views without data to show are left out."""
+    urls = [('home', reverse('home'))]
+    urls += [(f'home_{sorting.value}', f"{reverse('home')}?sorting={sorting.value}") for sorting in FeedSorting]
+    urls.append(('profile', reverse('profile', args=[user.pk])))
+    popular = Profile.objects.exclude(user=user).order_by('-followers_count', 'id').values_list('user_id', flat=True)
+    if popular:
+        urls.append(('profile_popular', reverse('profile', args=[popular[0]])))
+    urls.append(('map_view', reverse('map_page')))
+    urls.append(('chat_list', reverse('chat_list')))
+
+    conversations = Conversation.sidebar(user).order_by('-date_last', '-id')
+    dialog = conversations.filter(group_chat=None).first()
+    if dialog is not None:
+        urls.append(('chat_by_user', reverse('chat_by_user', args=[dialog.peer.username])))
+    group = conversations.exclude(group_chat=None).first()
+    if group is not None:
+        urls.append(('group_chat', reverse('group_chat', args=[group.group_chat_id])))
+    return urls
+
+
+def _measure(client, url):
+    started = time.perf_counter()
+    response = client.get(url)
+    return response, (time.perf_counter() - started) * 1000
+
+
+def benchmark_view(client, url, repeat):
+    """
+    Time `repeat` requests of `url` after a first, cold one, then count the queries
+    of one more and trace the peak Python memory of a last one separately,
+    as tracing slows every allocation down.
+    """
+    response, first_ms = _measure(client, url)
+    timings = [_measure(client, url)[1] for _ in range(repeat)]
+
+    counter = QueryCounter()
+    with connection.execute_wrapper(counter):
+        client.get(url)
+
+    tracemalloc.start()
+    try:
+        client.get(url)
+        peak = tracemalloc.get_traced_memory()[1]
+    finally:
+        tracemalloc.stop()
+
+    return {
+        'url': url,
+        'status': response.status_code,
+        'first_ms': round(first_ms, 2),
+        'min_ms': round(min(timings), 2),
+        'median_ms': round(statistics.median(timings), 2),
+        'max_ms': round(max(timings), 2),
+        'queries': counter.queries,
+        'query_ms': round(counter.seconds * 1000, 2),
+        'peak_memory_kb': round(peak / 1024, 1),
+    }
+
+
+def run_benchmark(user, repeat=5, views=None):
+    client = Client()
+    client.force_login(user)
+    report = {
+        'database': connection.vendor,
+        'user': user.username,
+        'repeat': repeat,
+        'data': {
+            'users': User.objects.count(),
+            'posts': Post.objects.count(),
+            'follows': Profile.follows.through.objects.count(),
+        },
+        'views': {},
+    }
+    # the test client always asks for the 'testserver' host
+    with override_settings(ALLOWED_HOSTS=['testserver']):
+        for name, url in view_urls(user):
+            if views and name not in views:
+                continue
+            report['views'][name] = benchmark_view(client, url, repeat)
+    return report
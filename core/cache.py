@@ -0,0 +1,151 @@
+import threading
+import time
+from collections import OrderedDict
+
+from django.core.cache import cache as shared_cache
+
+from TamTut.settings import CACHE_L1_MAX_ENTRIES, CACHE_L1_TIMEOUT, CACHE_VERSION_L1_TIMEOUT
+
+_MISSING = object()
+
+
+class LRUCache:
+    """Bounded in-process cache evicting the least recently used entry, entries expire after a timeout."""
+
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._entries.get(key, _MISSING)
+            if entry is _MISSING:
+                return default
+            value, expires = entry
+            if expires < time.monotonic():
+                del self._entries[key]
+                return default
+            self._entries.move_to_end(key)
+            return value
+
+    def set(self, key, value, timeout):
+        with self._lock:
+            self._entries[key] = (value, time.monotonic() + timeout)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def delete(self, key):
+        with self._lock:
+            self._entries.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def __len__(self):
+        return len(self._entries)
+
+
+class TwoTierCache:
+    """
+    An in-process LRU (L1) in front of the shared Django cache (L2).
+
+    Cached values are meant to be stored under keys embedding the versions of
+    the objects they were built from, see `versioned_key`; changing an object
+    bumps its version, so stale entries are never read again and just age out.
+    """
+
+    def __init__(self, l1, l2):
+        self.l1 = l1
+        self.l2 = l2
+        self._stats_lock = threading.Lock()
+        self.stats = {'l1_hits': 0, 'l2_hits': 0, 'misses': 0, 'sets': 0}
+
+    def _count(self, counter):
+        with self._stats_lock:
+            self.stats[counter] += 1
+
+    def get(self, key, default=None):
+        value = self.l1.get(key, _MISSING)
+        if value is not _MISSING:
+            self._count('l1_hits')
+            return value
+        value = self.l2.get(key, _MISSING)
+        if value is not _MISSING:
+            self._count('l2_hits')
+            self.l1.set(key, value, CACHE_L1_TIMEOUT)
+            return value
+        self._count('misses')
+        return default
+
+    def set(self, key, value, timeout=None):
+        self._count('sets')
+        self.l1.set(key, value, CACHE_L1_TIMEOUT if timeout is None else min(timeout, CACHE_L1_TIMEOUT))
+        self.l2.set(key, value, timeout)
+
+    def get_or_set(self, key, build, timeout=None):
+        value = self.get(key, _MISSING)
+        if value is _MISSING:
+            value = build()
+            self.set(key, value, timeout)
+        return value
+
+    def get_stats(self):
+        with self._stats_lock:
+            stats = dict(self.stats)
+        lookups = stats['l1_hits'] + stats['l2_hits'] + stats['misses']
+        stats['l1_entries'] = len(self.l1)
+        stats['l1_max_entries'] = self.l1.max_entries
+        stats['hit_ratio'] = (stats['l1_hits'] + stats['l2_hits']) / lookups if lookups else 0.0
+        return stats
+
+
+cache = TwoTierCache(LRUCache(CACHE_L1_MAX_ENTRIES), shared_cache)
+# versions live in L2 so every worker sees a bump, L1 only spares the lookup for a moment
+_versions = LRUCache(CACHE_L1_MAX_ENTRIES)
+
+
+def _version_key(label, pk):
+    return f'version:{label}:{pk}'
+
+
+def _label_and_pk(obj):
+    if isinstance(obj, tuple):
+        return obj
+    return obj._meta.label_lower, obj.pk
+
+
+def object_version(obj):
+    """Current version of a model instance or a (label, pk) pair, e.g. ('core.post', 1)."""
+    key = _version_key(*_label_and_pk(obj))
+    version = _versions.get(key)
+    if version is None:
+        version = shared_cache.get(key)
+        if version is None:
+            # a fresh start, so entries left over from an evicted version can't be picked up
+            shared_cache.add(key, int(time.time() * 1000), None)
+            version = shared_cache.get(key)
+        _versions.set(key, version, CACHE_VERSION_L1_TIMEOUT)
+    return version
+
+
+def bump_version(label, pk):
+    key = _version_key(label, pk)
+    try:
+        version = shared_cache.incr(key)
+    except ValueError:
+        version = int(time.time() * 1000)
+        shared_cache.set(key, version, None)
+    _versions.set(key, version, CACHE_VERSION_L1_TIMEOUT)
+    return version
+
+
+def versioned_key(name, *objects):
+    """Cache key for `name` built from `objects`, it changes whenever one of them is changed."""
+    parts = [name]
+    for obj in objects:
+        label, pk = _label_and_pk(obj)
+        parts.append(f'{label}.{pk}.{object_version((label, pk))}')
+    return ':'.join(parts)
@@ -0,0 +1,64 @@
+"""
+The PostgreSQL backend with connections checked out of a per-process pool,
+selected with DB_CONNECTION_MODE=pooled. Django closes the connection of a
+request when it finishes, which hands it back to the pool instead.
+"""
+from django.db.backends.postgresql import base
+from psycopg2.extensions import TRANSACTION_STATUS_IDLE
+
+from TamTut.settings import DB_POOL_SIZE, DB_POOL_TIMEOUT, DB_POOL_CHECK_AFTER, DB_POOL_MAX_AGE
+from core.db_pool.pool import ConnectionPool, PoolTimeout, get_pool
+
+Database = base.Database
+
+
+def ping(connection):
+    with connection.cursor() as cursor:
+        cursor.execute('SELECT 1')
+    if not connection.autocommit:
+        connection.rollback()
+    return True
+
+
+class DatabaseWrapper(base.DatabaseWrapper):
+
+    def get_pool(self, conn_params):
+        return get_pool(self.alias, lambda: ConnectionPool(
+            connect=lambda: Database.connect(**conn_params),
+            size=DB_POOL_SIZE,
+            timeout=DB_POOL_TIMEOUT,
+            check_after=DB_POOL_CHECK_AFTER,
+            max_age=DB_POOL_MAX_AGE,
+            ping=ping,
+            close=lambda connection: connection.close(),
+        ))
+
+    def get_new_connection(self, conn_params):
+        try:
+            connection = self.get_pool(conn_params).checkout()
+        except PoolTimeout as e:
+            raise Database.OperationalError(str(e))
+
+        # what the base backend does with a fresh connection
+        options = self.settings_dict['OPTIONS']
+        try:
+            self.isolation_level = options['isolation_level']
+        except KeyError:
+            self.isolation_level = connection.isolation_level
+        else:
+            if self.isolation_level != connection.isolation_level:
+                connection.set_session(isolation_level=self.isolation_level)
+        return connection
+
+    def _close(self):
+        if self.connection is None:
+            return
+        with self.wrap_database_errors:
+            # closed inside an atomic block, Django keeps referring to the connection, so it can't be shared
+            reusable = not self.connection.closed and not self.in_atomic_block and not self.errors_occurred
+            if reusable and self.connection.get_transaction_status() != TRANSACTION_STATUS_IDLE:
+                try:
+                    self.connection.rollback()
+                except Database.Error:
+                    reusable = False
+            self.get_pool(self.get_connection_params()).release(self.connection, reusable)
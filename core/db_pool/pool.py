@@ -0,0 +1,204 @@
+import bisect
+import threading
+import time
+from collections import deque
+
+# seconds a checkout waited for a free connection
+WAIT_BUCKETS = (0.001, 0.005, 0.01, 0.05, 0.1, 0.5, 1, 5)
+# stats of the current state rather than totals
+GAUGES = ('size', 'opened', 'idle', 'in_use')
+
+
+class PoolTimeout(Exception):
+    pass
+
+
+class PooledConnection:
+    def __init__(self, raw):
+        self.raw = raw
+        self.created = time.monotonic()
+        self.released = self.created
+
+
+class ConnectionPool:
+    """
+    At most `size` connections made by `connect()`, handed out by `checkout` and
+    taken back by `release`. A checkout waits up to `timeout` seconds for a free
+    connection. Connections idle for `check_after` seconds are checked with
+    `ping` before they are handed out, and ones older than `max_age` are replaced.
+    """
+
+    def __init__(self, connect, size, timeout, check_after, max_age, ping, close):
+        self.connect = connect
+        self.size = size
+        self.timeout = timeout
+        self.check_after = check_after
+        self.max_age = max_age
+        self.ping = ping
+        self.close = close
+
+        self._idle = deque()
+        self._opened = 0
+        self._in_use = {}
+        self._available = threading.Condition(threading.Lock())
+        self.stats = {'checkouts': 0, 'waits': 0, 'timeouts': 0, 'created': 0, 'discarded': 0,
+                      'wait_seconds': 0.0, 'max_wait_seconds': 0.0}
+        self.wait_bucket_counts = [0] * (len(WAIT_BUCKETS) + 1)
+
+    def checkout(self):
+        started = time.monotonic()
+        with self._available:
+            while not self._idle and self._opened >= self.size:
+                remaining = started + self.timeout - time.monotonic()
+                if remaining <= 0:
+                    self.stats['timeouts'] += 1
+                    raise PoolTimeout(f'No free connection in the pool of {self.size} after {self.timeout}s')
+                self._available.wait(remaining)
+            pooled = self._idle.pop() if self._idle else None
+            if pooled is None:
+                # reserve the slot, the connection is made outside the lock
+                self._opened += 1
+            self._record_wait(time.monotonic() - started)
+
+        try:
+            if pooled is not None and not self._is_healthy(pooled):
+                self._discard(pooled, keep_slot=True)
+                pooled = None
+            if pooled is None:
+                pooled = PooledConnection(self.connect())
+                with self._available:
+                    self.stats['created'] += 1
+        except BaseException:
+            with self._available:
+                self._opened -= 1
+                self._available.notify()
+            raise
+
+        with self._available:
+            self._in_use[id(pooled.raw)] = pooled
+        return pooled.raw
+
+    def release(self, raw, reusable=True):
+        with self._available:
+            pooled = self._in_use.pop(id(raw), None)
+        if pooled is None:
+            # not ours, e.g. checked out before the pool was reset
+            self.close(raw)
+            return
+        if not reusable or time.monotonic() - pooled.created > self.max_age:
+            self._discard(pooled)
+            return
+        pooled.released = time.monotonic()
+        with self._available:
+            # the most recently used connection is handed out first, so spare ones age out
+            self._idle.append(pooled)
+            self._available.notify()
+
+    def close_all(self):
+        with self._available:
+            idle, self._idle = list(self._idle), deque()
+            self._opened -= len(idle)
+            self._available.notify_all()
+        for pooled in idle:
+            self.close(pooled.raw)
+
+    def _is_healthy(self, pooled):
+        now = time.monotonic()
+        if now - pooled.created > self.max_age:
+            return False
+        if now - pooled.released < self.check_after:
+            return True
+        try:
+            return self.ping(pooled.raw)
+        except Exception:
+            return False
+
+    def _discard(self, pooled, keep_slot=False):
+        try:
+            self.close(pooled.raw)
+        except Exception:
+            pass
+        with self._available:
+            self.stats['discarded'] += 1
+            if not keep_slot:
+                self._opened -= 1
+                self._available.notify()
+
+    def _record_wait(self, seconds):
+        # called with the lock held
+        self.stats['checkouts'] += 1
+        self.stats['wait_seconds'] += seconds
+        self.stats['max_wait_seconds'] = max(self.stats['max_wait_seconds'], seconds)
+        if seconds >= WAIT_BUCKETS[0]:
+            self.stats['waits'] += 1
+        self.wait_bucket_counts[bisect.bisect_left(WAIT_BUCKETS, seconds)] += 1
+
+    def get_stats(self):
+        with self._available:
+            stats = dict(self.stats)
+            stats.update(size=self.size, opened=self._opened, idle=len(self._idle), in_use=len(self._in_use))
+            stats['wait_bucket_counts'] = list(self.wait_bucket_counts)
+        return stats
+
+
+_pools = {}
+_pools_lock = threading.Lock()
+
+
+def get_pool(alias, factory):
+    """The pool of a database alias in this process, made by `factory()` on first use."""
+    with _pools_lock:
+        pool = _pools.get(alias)
+        if pool is None:
+            pool = _pools[alias] = factory()
+        return pool
+
+
+def close_pools():
+    """Close the idle connections of every pool, e.g. in the gunicorn master before it forks workers."""
+    with _pools_lock:
+        pools = list(_pools.values())
+        _pools.clear()
+    for pool in pools:
+        pool.close_all()
+
+
+def pool_counters():
+    with _pools_lock:
+        pools = list(_pools.items())
+    return {alias: {key: value for key, value in pool.get_stats().items() if key not in GAUGES}
+            for alias, pool in pools}
+
+
+def pool_gauges():
+    with _pools_lock:
+        pools = list(_pools.items())
+    return {alias: {key: value for key, value in pool.get_stats().items() if key in GAUGES} for alias, pool in pools}
+
+
+def render_pool_metrics(counters=None, gauges=None):
+    """
+    Pool metrics in the Prometheus text exposition format, of `counters` and
+    `gauges` as collected from every worker by core.metrics.worker_totals, or of this process.
+    """
+    counters = pool_counters() if counters is None else counters
+    gauges = pool_gauges() if gauges is None else gauges
+    lines = []
+    for alias in sorted(counters.keys() | gauges.keys()):
+        label = f'alias="{alias}"'
+        if alias in counters:
+            stats = counters[alias]
+            cumulative = 0
+            for bound, amount in zip(WAIT_BUCKETS + ('+Inf',), stats['wait_bucket_counts']):
+                cumulative += amount
+                lines.append(f'tamtut_db_pool_wait_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'tamtut_db_pool_wait_seconds_sum{{{label}}} {stats["wait_seconds"]:.6f}')
+            lines.append(f'tamtut_db_pool_wait_seconds_count{{{label}}} {stats["checkouts"]}')
+            for counter in ('timeouts', 'created', 'discarded'):
+                lines.append(f'tamtut_db_pool_{counter}_total{{{label}}} {stats[counter]}')
+        for gauge in GAUGES:
+            if gauge in gauges.get(alias, {}):
+                lines.append(f'tamtut_db_pool_{gauge}{{{label}}} {gauges[alias][gauge]}')
+    if lines:
+        lines[:0] = ['# TYPE tamtut_db_pool_wait_seconds histogram']
+    return '\n'.join(lines) + '\n' if lines else ''
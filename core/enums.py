@@ -5,3 +5,7 @@ class FeedSorting(Enum):
     NEW = 'new'
     HOT = 'hot'
     BEST = 'best'
+
+
+class MapRanking(Enum):
+    NEARBY = 'nearby'
@@ -0,0 +1,198 @@
+import datetime
+
+import numpy as np
+from django.contrib.auth.hashers import make_password
+from django.contrib.auth.models import User
+from django.db import transaction
+from django.utils import timezone
+
+from TamTut.settings import TIMELINE_BACKFILL_POSTS, FANOUT_FOLLOWERS_LIMIT
+from core.geo import grid_cell
+from core.models import Profile, Hobby, Post, TimelineEntry, Message, GroupChat, Conversation
+
+WORDS = ('lorem ipsum dolor sit amet consectetur adipiscing elit sed do eiusmod tempor incididunt ut labore et '
+         'dolore magna aliqua enim ad minim veniam quis nostrud exercitation ullamco laboris nisi aliquip').split()
+# generated profiles are spread around a few city centres, so map viewports hold dense and sparse cells
+CITIES = ((55.75, 37.62), (59.94, 30.31), (55.79, 49.11), (56.84, 60.60))
+
+
+def zipf_weights(n, skew, rng):
+    """Probabilities of `n` items falling off as rank ** -skew, ranks shuffled over the items."""
+    weights = np.arange(1, n + 1, dtype=np.float64) ** -skew
+    rng.shuffle(weights)
+    return weights / weights.sum()
+
+
+def sample_pairs(rng, sources, targets, per_source, weights=None):
+    """
+    Distinct (source, target) pairs, a Poisson(`per_source`) amount for every source,
+    targets drawn with `weights`. Pairs of an item with itself are dropped.
+    """
+    amounts = rng.poisson(per_source, len(sources))
+    left = np.repeat(sources, amounts)
+    right = rng.choice(targets, size=len(left), p=weights)
+    pairs = np.unique(np.stack([left, right], axis=1), axis=0)
+    return pairs[pairs[:, 0] != pairs[:, 1]]
+
+
+def random_text(rng, min_words, max_words):
+    return ' '.join(rng.choice(WORDS, size=rng.integers(min_words, max_words + 1)))
+
+
+def generate(users=1000, prefix='fake', hobbies=50, hobbies_per_profile=3, follows_per_user=20, follower_skew=1.1,
+             posts_per_user=5, likes_per_user=30, like_skew=1.2, messages_per_user=10, group_chats=20,
+             group_chat_users=15, messages_per_group_chat=50, days=30, seed=0, password='password', batch_size=500):
+    """
+    Bulk-create a social graph of `users` users with power-law follower and like counts.
+
+    Everything is written with bulk_create, which sends no signals, so the data
+    the signals maintain (counters, timelines, conversations) is built here in bulk.
+    Returns the amount of created rows per model.
+    """
+    if User.objects.filter(username__startswith=f'{prefix}_').exists():
+        raise ValueError(f'Users prefixed with "{prefix}_" already exist')
+    rng = np.random.default_rng(seed)
+    now = timezone.now()
+
+    with transaction.atomic():
+        password = make_password(password)
+        User.objects.bulk_create((User(username=f'{prefix}_{i}', email=f'{prefix}_{i}@example.com', password=password)
+                                  for i in range(users)), batch_size=batch_size)
+        user_ids = np.array(User.objects.filter(username__startswith=f'{prefix}_').order_by('id')
+                            .values_list('id', flat=True), dtype=np.int64)
+
+        cities = rng.integers(0, len(CITIES), users)
+        latitudes = np.array([CITIES[city][0] for city in cities]) + rng.normal(0, 0.15, users)
+        longitudes = np.array([CITIES[city][1] for city in cities]) + rng.normal(0, 0.25, users)
+        Profile.objects.bulk_create((
+            Profile(user_id=user_id, latitude=round(lat, 6), longitude=round(lng, 6), geo_cell=grid_cell(lat, lng))
+            for user_id, lat, lng in zip(user_ids.tolist(), latitudes.tolist(), longitudes.tolist())
+        ), batch_size=batch_size)
+        profile_ids = np.array(Profile.objects.filter(user_id__gte=int(user_ids[0])).order_by('user_id')
+                               .values_list('id', flat=True), dtype=np.int64)
+        user_of = dict(zip(profile_ids.tolist(), user_ids.tolist()))
+
+        Hobby.objects.bulk_create(Hobby(name=f'{prefix} hobby {i}') for i in range(hobbies))
+        hobby_ids = np.array(Hobby.objects.filter(name__startswith=f'{prefix} hobby ')
+                             .values_list('id', flat=True), dtype=np.int64)
+        hobby_pairs = sample_pairs(rng, profile_ids, hobby_ids, hobbies_per_profile,
+                                   zipf_weights(len(hobby_ids), 1.0, rng))
+        Profile.hobby.through.objects.bulk_create((
+            Profile.hobby.through(profile_id=profile_id, hobby_id=hobby_id)
+            for profile_id, hobby_id in hobby_pairs.tolist()
+        ), batch_size=batch_size)
+
+        follows = sample_pairs(rng, profile_ids, profile_ids, follows_per_user,
+                               zipf_weights(users, follower_skew, rng))
+        Profile.follows.through.objects.bulk_create((
+            Profile.follows.through(from_profile_id=follower, to_profile_id=followed)
+            for follower, followed in follows.tolist()
+        ), batch_size=batch_size)
+
+        authors = np.repeat(profile_ids, rng.poisson(posts_per_user, users))
+        Post.objects.bulk_create((Post(author_id=author, text=random_text(rng, 3, 40)) for author in authors.tolist()),
+                                 batch_size=batch_size)
+        posts = list(Post.objects.filter(author_id__gte=int(profile_ids[0])).only('id', 'author_id').order_by('id'))
+        # bulk_create stamps every post with the same auto_now_add date, spread them over `days`
+        ages = np.sort(rng.uniform(0, days * 86400, len(posts)))[::-1]
+        for post, age in zip(posts, ages.tolist()):
+            post.date_posted = now - datetime.timedelta(seconds=age)
+        Post.objects.bulk_update(posts, ['date_posted'], batch_size=batch_size)
+        post_ids = np.array([post.id for post in posts], dtype=np.int64)
+
+        likes = sample_pairs(rng, profile_ids, post_ids, likes_per_user, zipf_weights(len(post_ids), like_skew, rng)) \
+            if len(post_ids) else np.empty((0, 2), dtype=np.int64)
+        Post.liked_by.through.objects.bulk_create((
+            Post.liked_by.through(profile_id=profile_id, post_id=post_id) for profile_id, post_id in likes.tolist()
+        ), batch_size=batch_size)
+
+        # direct messages go to people the sender follows, so dialogs cluster like real ones
+        dialogs = follows[rng.choice(len(follows), size=users * messages_per_user)] \
+            if len(follows) else np.empty((0, 2), dtype=np.int64)
+        Message.objects.bulk_create((
+            Message(sender_id=user_of[sender], receiver_id=user_of[receiver], msg_text=random_text(rng, 1, 20))
+            for sender, receiver in dialogs.tolist()
+        ), batch_size=batch_size)
+
+        GroupChat.objects.bulk_create(
+            GroupChat(author_id=int(user_ids[rng.integers(users)]), chat_title=f'{prefix} chat {i}')
+            for i in range(group_chats)
+        )
+        chats = list(GroupChat.objects.filter(chat_title__startswith=f'{prefix} chat ').order_by('id'))
+        members = {chat.id: set(rng.choice(user_ids, size=min(users, group_chat_users), replace=False).tolist())
+                   | {chat.author_id} for chat in chats}
+        GroupChat.chat_users.through.objects.bulk_create((
+            GroupChat.chat_users.through(groupchat_id=chat_id, user_id=user_id)
+            for chat_id, chat_members in members.items() for user_id in chat_members
+        ), batch_size=batch_size)
+        Message.objects.bulk_create((
+            Message(sender_id=int(rng.choice(list(chat_members))), group_chat_in_id=chat_id,
+                    msg_text=random_text(rng, 1, 20))
+            for chat_id, chat_members in members.items() for _ in range(messages_per_group_chat)
+        ), batch_size=batch_size)
+
+        messages = list(Message.objects.filter(sender_id__gte=int(user_ids[0])).only('id'))
+        # spread like the posts, conversations pick their last message by date
+        for message, age in zip(messages, rng.uniform(0, days * 86400, len(messages)).tolist()):
+            message.date_sent = now - datetime.timedelta(seconds=age)
+        Message.objects.bulk_update(messages, ['date_sent'], batch_size=batch_size)
+
+        # the generated rows have the highest ids, so ranges select them without huge IN lists
+        profiles = Profile.objects.filter(id__gte=int(profile_ids[0]))
+        generated_posts = Post.objects.filter(id__gte=int(post_ids[0])) if len(post_ids) else Post.objects.none()
+        Post.refresh_likes_count(generated_posts)
+        Post.refresh_hot_scores(generated_posts)
+        Profile.refresh_counters(profiles)
+        timeline_entries = _build_timelines(follows, posts, batch_size)
+        conversations = _build_conversations(user_ids, chats, members, batch_size)
+
+    return {
+        'users': users, 'hobbies': len(hobby_ids), 'profile_hobbies': len(hobby_pairs), 'follows': len(follows),
+        'posts': len(post_ids), 'likes': len(likes), 'direct_messages': len(dialogs), 'group_chats': len(chats),
+        'group_messages': len(chats) * messages_per_group_chat, 'timeline_entries': timeline_entries,
+        'conversations': conversations,
+    }
+
+
+def _build_timelines(follows, posts, batch_size):
+    followers_amount = np.bincount(follows[:, 1]) if len(follows) else np.zeros(0, dtype=np.int64)
+    latest = {}
+    for post in sorted(posts, key=lambda post: post.date_posted, reverse=True):
+        author_posts = latest.setdefault(post.author_id, [])
+        if len(author_posts) < TIMELINE_BACKFILL_POSTS:
+            author_posts.append(post)
+
+    entries = [
+        TimelineEntry(profile_id=follower, post_id=post.id, date_posted=post.date_posted)
+        for follower, followed in follows.tolist() if followers_amount[followed] <= FANOUT_FOLLOWERS_LIMIT
+        for post in latest.get(followed, ())
+    ]
+    TimelineEntry.objects.bulk_create(entries, batch_size=batch_size, ignore_conflicts=True)
+    return len(entries)
+
+
+def _build_conversations(user_ids, chats, members, batch_size):
+    messages = Message.objects.filter(sender_id__gte=int(user_ids[0])).order_by('date_sent', 'id')
+    last = {}
+    fields = ('id', 'sender_id', 'receiver_id', 'group_chat_in_id', 'msg_text', 'date_sent')
+    for message in messages.only(*fields).iterator():
+        if message.group_chat_in_id is not None:
+            last[message.group_chat_in_id] = message
+        else:
+            last[message.sender_id, message.receiver_id] = last[message.receiver_id, message.sender_id] = message
+
+    conversations = [
+        Conversation(user_id=key[0], peer_id=key[1], last_message=message, preview=message.msg_text[:100],
+                     date_last=message.date_sent)
+        for key, message in last.items() if isinstance(key, tuple)
+    ]
+    for chat in chats:
+        message = last.get(chat.id)
+        conversations.extend(
+            Conversation(user_id=user_id, group_chat=chat, last_message=message,
+                         preview=message.msg_text[:100] if message else '',
+                         date_last=message.date_sent if message else chat.date_created)
+            for user_id in members[chat.id]
+        )
+    Conversation.objects.bulk_create(conversations, batch_size=batch_size)
+    return len(conversations)
@@ -0,0 +1,54 @@
+import math
+
+from django.db.models import Q
+
+from TamTut.settings import MAP_GRID_DEGREES
+
+GRID_ROWS = math.ceil(180 / MAP_GRID_DEGREES)
+GRID_COLUMNS = math.ceil(360 / MAP_GRID_DEGREES)
+# beyond this many grid rows a viewport is scanned as one range of whole rows
+MAX_VIEWPORT_ROWS = 64
+
+
+def _row(lat):
+    return min(max(int((lat + 90) // MAP_GRID_DEGREES), 0), GRID_ROWS - 1)
+
+
+def _column(lng):
+    return min(max(int((lng + 180) // MAP_GRID_DEGREES), 0), GRID_COLUMNS - 1)
+
+
+def grid_cell(lat, lng):
+    """Number of the grid cell containing the point, cells are numbered row by row from the south-west."""
+    if lat is None or lng is None:
+        return None
+    return _row(lat) * GRID_COLUMNS + _column(lng)
+
+
+def viewport_cells(south, west, north, east):
+    """
+    Q over `geo_cell` matching the cells that cover the bounding box, one
+    index range per grid row. A box crossing the antimeridian has west > east.
+    """
+    rows = range(_row(south), _row(north) + 1)
+    if west <= east:
+        columns = [(_column(west), _column(east))]
+    else:
+        columns = [(_column(west), GRID_COLUMNS - 1), (0, _column(east))]
+
+    if len(rows) > MAX_VIEWPORT_ROWS:
+        return Q(geo_cell__range=(rows[0] * GRID_COLUMNS, (rows[-1] + 1) * GRID_COLUMNS - 1))
+
+    condition = Q()
+    for row in rows:
+        for first, last in columns:
+            condition |= Q(geo_cell__range=(row * GRID_COLUMNS + first, row * GRID_COLUMNS + last))
+    return condition
+
+
+def in_viewport(south, west, north, east):
+    """Exact filter on the coordinates, applied on top of `viewport_cells`."""
+    condition = Q(latitude__gte=south, latitude__lte=north)
+    if west <= east:
+        return condition & Q(longitude__gte=west, longitude__lte=east)
+    return condition & (Q(longitude__gte=west) | Q(longitude__lte=east))
@@ -0,0 +1,73 @@
+import threading
+import time
+
+import numpy as np
+
+from TamTut.settings import HOBBY_INDEX_TTL
+from core.cache import object_version, bump_version
+from core.models import Profile
+
+
+class HobbyIndex:
+    """Inverted index from hobby id to the sorted array of ids of the profiles having it."""
+
+    def __init__(self, pairs):
+        postings = {}
+        for profile_id, hobby_id in pairs:
+            postings.setdefault(hobby_id, []).append(profile_id)
+        self.postings = {hobby_id: np.unique(np.asarray(ids, dtype=np.int64)) for hobby_id, ids in postings.items()}
+
+    @staticmethod
+    def load():
+        return HobbyIndex(Profile.hobby.through.objects.values_list('profile_id', 'hobby_id').iterator())
+
+    def _lists(self, hobby_ids):
+        empty = np.empty(0, dtype=np.int64)
+        # intersecting the shortest lists first keeps the intermediate results small
+        return sorted((self.postings.get(hobby_id, empty) for hobby_id in set(hobby_ids)), key=len)
+
+    def with_all(self, hobby_ids):
+        lists = self._lists(hobby_ids)
+        if not lists:
+            return np.empty(0, dtype=np.int64)
+        matched = lists[0]
+        for ids in lists[1:]:
+            matched = np.intersect1d(matched, ids, assume_unique=True)
+        return matched
+
+    def with_any(self, hobby_ids):
+        lists = self._lists(hobby_ids)
+        if not lists:
+            return np.empty(0, dtype=np.int64)
+        return np.unique(np.concatenate(lists))
+
+
+# bumped in the shared cache on hobby changes, so every worker notices and rebuilds its index
+INDEX_VERSION = ('core.hobby_index', 0)
+
+_index = None
+_index_version = None
+_index_loaded = 0.0
+_index_lock = threading.Lock()
+
+
+def hobby_index():
+    """
+    Process-wide index, rebuilt when INDEX_VERSION differs from the one it was
+    built at (after `invalidate_hobby_index` in any worker) or every HOBBY_INDEX_TTL seconds.
+    """
+    global _index, _index_version, _index_loaded
+    version = object_version(INDEX_VERSION)
+    with _index_lock:
+        if _index is None or _index_version != version or time.monotonic() - _index_loaded > HOBBY_INDEX_TTL:
+            _index = HobbyIndex.load()
+            _index_version = version
+            _index_loaded = time.monotonic()
+        return _index
+
+
+def invalidate_hobby_index():
+    global _index
+    bump_version(*INDEX_VERSION)
+    with _index_lock:
+        _index = None
@@ -0,0 +1,112 @@
+import io
+import logging
+import os
+import threading
+import uuid
+from concurrent.futures import ThreadPoolExecutor
+
+from PIL import Image
+from django.core.files.base import ContentFile
+
+from TamTut.settings import IMAGE_VARIANT_SIZES, IMAGE_PROCESSING_WORKERS
+from core.cache import cache, bump_version
+
+logger = logging.getLogger(__name__)
+
+VARIANTS_DIR = 'variants'
+# modes carrying an alpha channel, converted to RGBA rather than flattened to RGB
+ALPHA_MODES = ('LA', 'La', 'PA', 'RGBa')
+# a missing variant is looked up again after this many seconds, generating it marks it present right away
+MISSING_VARIANT_TIMEOUT = 60
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def variant_name(name, size):
+    stem = os.path.splitext(name)[0]
+    return f'{VARIANTS_DIR}/{stem}_{size}.webp'
+
+
+def _exists_key(name):
+    return f'image_variant_exists:{name}'
+
+
+def variant_exists(storage, name):
+    """Whether the variant `name` is stored, asking the storage only on a cache miss."""
+    exists = cache.get(_exists_key(name))
+    if exists is None:
+        exists = storage.exists(name)
+        # variant names never change content, so a present one stays present
+        cache.set(_exists_key(name), exists, None if exists else MISSING_VARIANT_TIMEOUT)
+    return exists
+
+
+def variant_url(image, size):
+    """URL of the `size` px variant of an image field file, the original until the variant is generated."""
+    name = variant_name(image.name, size)
+    if variant_exists(image.storage, name):
+        return image.storage.url(name)
+    return image.url
+
+
+def _save_replacing(storage, name, data):
+    # written under a temporary name and renamed into place, so a variant is never served half written
+    temp_name = storage.save(f'{name}.{uuid.uuid4().hex}.tmp', ContentFile(data))
+    os.replace(storage.path(temp_name), storage.path(name))
+
+
+def generate_variants(storage, name, sizes=IMAGE_VARIANT_SIZES):
+    """Generate the missing variants of `name`, the stored ones are kept as they are served as immutable."""
+    missing = {size for size in sizes if not storage.exists(variant_name(name, size))}
+    if not missing:
+        return
+
+    with storage.open(name) as original:
+        img = Image.open(original)
+        img.load()
+    if img.mode not in ('RGB', 'RGBA'):
+        img = img.convert('RGBA' if img.mode in ALPHA_MODES or 'transparency' in img.info else 'RGB')
+
+    for size in sorted(sizes, reverse=True):
+        # every smaller variant is scaled down from the previous, larger one
+        img.thumbnail((size, size), Image.LANCZOS)
+        if size not in missing:
+            continue
+        output = io.BytesIO()
+        img.save(output, format='WEBP', quality=80, method=4)
+        target = variant_name(name, size)
+        _save_replacing(storage, target, output.getvalue())
+        cache.set(_exists_key(target), True, None)
+
+
+def _generate_variants_safely(storage, name, owner):
+    try:
+        generate_variants(storage, name)
+    except Exception:
+        logger.exception('Failed to generate image variants of %s', name)
+        return
+    # fragments cached meanwhile point at the original, they are rendered again with the variants
+    bump_version(*owner)
+
+
+def schedule_variants(image):
+    """
+    Generate the variants of an image field file on the worker pool, or inline
+    without workers, then bump the cache version of the instance holding it.
+    """
+    storage, name = image.storage, image.name
+    owner = (image.instance._meta.label_lower, image.instance.pk)
+    if IMAGE_PROCESSING_WORKERS <= 0:
+        _generate_variants_safely(storage, name, owner)
+        return
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=IMAGE_PROCESSING_WORKERS, thread_name_prefix='images')
+    _executor.submit(_generate_variants_safely, storage, name, owner)
+
+
+def has_variants(image):
+    return variant_exists(image.storage, variant_name(image.name, min(IMAGE_VARIANT_SIZES)))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Recompute the denormalized Post.likes_count column from the liked_by table'
+
+    def handle(self, *args, **options):
+        updated = Post.refresh_likes_count()
+        self.stdout.write(self.style.SUCCESS(f'Updated likes count of {updated} posts'))
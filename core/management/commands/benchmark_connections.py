@@ -0,0 +1,97 @@
+import json
+import statistics
+import threading
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db.utils import ConnectionHandler
+
+from TamTut.settings import DATABASES, DB_CONN_MAX_AGE
+from core.db_pool.pool import get_pool
+
+MODES = {
+    'fresh': {'ENGINE': 'django.db.backends.postgresql', 'CONN_MAX_AGE': 0},
+    'persistent': {'ENGINE': 'django.db.backends.postgresql', 'CONN_MAX_AGE': DB_CONN_MAX_AGE},
+    'pooled': {'ENGINE': 'core.db_pool', 'CONN_MAX_AGE': 0},
+}
+# what the hot feed reads for a page
+DEFAULT_QUERY = 'SELECT id, text, likes_count FROM core_post ORDER BY hot_score DESC, id DESC LIMIT 20'
+
+
+def percentile(sorted_values, share):
+    return sorted_values[min(int(len(sorted_values) * share), len(sorted_values) - 1)]
+
+
+class Command(BaseCommand):
+    help = ('Time request-like cycles of connect, query and close against PostgreSQL '
+            'with fresh, persistent and pooled connections, and report them as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--requests', type=int, default=500, help='Cycles per mode')
+        parser.add_argument('--threads', type=int, default=1, help='Concurrent threads, like gunicorn gthread')
+        parser.add_argument('--mode', action='append', dest='modes', choices=list(MODES),
+                            help='Only benchmark this mode, repeatable')
+        parser.add_argument('--query', default=DEFAULT_QUERY)
+
+    def handle(self, *args, **options):
+        if 'postgresql' not in DATABASES['default']['ENGINE'] and DATABASES['default']['ENGINE'] != 'core.db_pool':
+            raise CommandError('The connection benchmark needs the PostgreSQL database')
+
+        report = {'requests': options['requests'], 'threads': options['threads'], 'modes': {}}
+        for mode in options['modes'] or list(MODES):
+            report['modes'][mode] = self.benchmark(mode, options['requests'], options['threads'], options['query'])
+        self.stdout.write(json.dumps(report, indent=2))
+
+    def benchmark(self, mode, requests, threads, query):
+        # an alias of its own, so the pooled mode doesn't share the pool of the running app
+        alias = f'benchmark_{mode}'
+        handler = ConnectionHandler({'default': DATABASES['default'], alias: dict(DATABASES['default'], **MODES[mode])})
+        timings, errors = [], []
+        timings_lock = threading.Lock()
+
+        def worker(cycles):
+            measured = []
+            try:
+                connection = handler[alias]
+                for _ in range(cycles):
+                    started = time.perf_counter()
+                    # what the request_started and request_finished signals do around a request
+                    connection.close_if_unusable_or_obsolete()
+                    with connection.cursor() as cursor:
+                        cursor.execute(query)
+                        cursor.fetchall()
+                    connection.close_if_unusable_or_obsolete()
+                    measured.append((time.perf_counter() - started) * 1000)
+                connection.close()
+            except Exception as e:
+                errors.append(e)
+            with timings_lock:
+                timings.extend(measured)
+
+        started = time.perf_counter()
+        workers = [threading.Thread(target=worker, args=(requests // threads + (i < requests % threads),))
+                   for i in range(threads)]
+        for thread in workers:
+            thread.start()
+        for thread in workers:
+            thread.join()
+        total = time.perf_counter() - started
+        if errors:
+            raise CommandError(f'{mode}: {errors[0]!r}')
+
+        timings.sort()
+        result = {
+            'total_seconds': round(total, 3),
+            'requests_per_second': round(len(timings) / total, 1),
+            'mean_ms': round(statistics.mean(timings), 3),
+            'median_ms': round(statistics.median(timings), 3),
+            'p95_ms': round(percentile(timings, 0.95), 3),
+            'p99_ms': round(percentile(timings, 0.99), 3),
+            'max_ms': round(timings[-1], 3),
+        }
+        if mode == 'pooled':
+            pool = get_pool(alias, lambda: None)
+            stats = pool.get_stats()
+            pool.close_all()
+            result['pool'] = {key: value for key, value in stats.items() if key != 'wait_bucket_counts'}
+        return result
@@ -0,0 +1,47 @@
+import json
+import statistics
+import time
+
+import numpy as np
+from django.core.management.base import BaseCommand
+
+from core.ranking import ProfileSnapshot
+
+
+class Command(BaseCommand):
+    help = ('Time the nearby ranking over a synthetic snapshot of located profiles around Moscow, '
+            'and report it as JSON')
+
+    def add_arguments(self, parser):
+        parser.add_argument('--profiles', type=int, default=300000)
+        parser.add_argument('--hobbies', type=int, default=50)
+        parser.add_argument('--hobbies-per-profile', type=int, default=3)
+        parser.add_argument('--k', type=int, default=50, help='Profiles ranked per request')
+        parser.add_argument('--repeat', type=int, default=20)
+        parser.add_argument('--target-ms', type=float, default=40, help='Budget of the median ranking')
+        parser.add_argument('--seed', type=int, default=0)
+
+    def handle(self, *args, **options):
+        rng = np.random.default_rng(options['seed'])
+        ids = np.arange(1, options['profiles'] + 1)
+        profile_ids = np.repeat(ids, options['hobbies_per_profile'])
+        hobby_ids = rng.integers(1, options['hobbies'] + 1, len(profile_ids))
+        snapshot = ProfileSnapshot(ids.tolist(), rng.uniform(55, 56, len(ids)).tolist(),
+                                   rng.uniform(37, 38, len(ids)).tolist(),
+                                   list(zip(profile_ids.tolist(), hobby_ids.tolist())))
+
+        timings = []
+        for _ in range(options['repeat']):
+            started = time.perf_counter()
+            snapshot.nearby(1, 55.5, 37.5, [1, 2, 3], k=options['k'])
+            timings.append((time.perf_counter() - started) * 1000)
+        median = statistics.median(timings)
+        self.stdout.write(json.dumps({
+            'profiles': options['profiles'],
+            'k': options['k'],
+            'min_ms': round(min(timings), 2),
+            'median_ms': round(median, 2),
+            'max_ms': round(max(timings), 2),
+            'target_ms': options['target_ms'],
+            'within_target': median <= options['target_ms'],
+        }, indent=2))
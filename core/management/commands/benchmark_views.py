@@ -0,0 +1,31 @@
+import json
+
+from django.contrib.auth.models import User
+from django.core.management.base import BaseCommand, CommandError
+
+from core.benchmark import benchmark_user, run_benchmark
+
+
+class Command(BaseCommand):
+    help = 'Request the main views through the test client and report wall time, queries and memory as JSON'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--username', help='Viewer, the user following the most profiles by default')
+        parser.add_argument('--repeat', type=int, default=5, help='Timed requests per view after a cold one')
+        parser.add_argument('--view', action='append', dest='views', help='Only benchmark this view, repeatable')
+        parser.add_argument('--output', help='Write the report to this file instead of stdout')
+
+    def handle(self, *args, **options):
+        if options['username']:
+            user = User.objects.filter(username=options['username']).first()
+        else:
+            user = benchmark_user()
+        if user is None:
+            raise CommandError('No user to benchmark with, generate data with generate_fake_data first')
+
+        report = json.dumps(run_benchmark(user, options['repeat'], options['views']), indent=2)
+        if options['output']:
+            with open(options['output'], 'w') as f:
+                f.write(report + '\n')
+        else:
+            self.stdout.write(report)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.similarity import rebuild_similar_profiles
+from TamTut.settings import SIMILAR_PROFILES_COUNT
+
+
+class Command(BaseCommand):
+    help = 'Recompute the most similar profiles by hobbies for every profile'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=SIMILAR_PROFILES_COUNT)
+
+    def handle(self, *args, **options):
+        profiles = rebuild_similar_profiles(k=options['top'])
+        self.stdout.write(self.style.SUCCESS(f'Computed similar profiles of {profiles} profiles'))
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from core.suggestions import rebuild_suggested_profiles
+from TamTut.settings import SUGGESTED_PROFILES_COUNT
+
+
+class Command(BaseCommand):
+    help = 'Recompute the "who to follow" suggestions of every profile from the follow graph'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--top', type=int, default=SUGGESTED_PROFILES_COUNT)
+
+    def handle(self, *args, **options):
+        profiles = rebuild_suggested_profiles(k=options['top'])
+        self.stdout.write(self.style.SUCCESS(f'Computed suggestions of {profiles} profiles'))
@@ -0,0 +1,38 @@
+import inspect
+
+from django.core.management.base import BaseCommand, CommandError
+
+from core.fake_data import generate
+
+
+class Command(BaseCommand):
+    help = 'Bulk-generate users, profiles, follows, posts, likes and chats with power-law popularity'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--users', type=int, default=1000)
+        parser.add_argument('--prefix', default='fake', help='Prefix of the generated usernames, hobbies and chats')
+        parser.add_argument('--hobbies', type=int, default=50)
+        parser.add_argument('--hobbies-per-profile', type=float, default=3)
+        parser.add_argument('--follows-per-user', type=float, default=20)
+        parser.add_argument('--follower-skew', type=float, default=1.1,
+                            help='Zipf exponent of the follower counts, 0 is uniform')
+        parser.add_argument('--posts-per-user', type=float, default=5)
+        parser.add_argument('--likes-per-user', type=float, default=30)
+        parser.add_argument('--like-skew', type=float, default=1.2, help='Zipf exponent of the like counts')
+        parser.add_argument('--messages-per-user', type=int, default=10)
+        parser.add_argument('--group-chats', type=int, default=20)
+        parser.add_argument('--group-chat-users', type=int, default=15)
+        parser.add_argument('--messages-per-group-chat', type=int, default=50)
+        parser.add_argument('--days', type=int, default=30, help='Posts are spread over this many last days')
+        parser.add_argument('--seed', type=int, default=0)
+        parser.add_argument('--password', default='password', help='Password of every generated user')
+
+    def handle(self, *args, **options):
+        params = {key: value for key, value in options.items() if key in inspect.signature(generate).parameters}
+        try:
+            created = generate(**params)
+        except ValueError as e:
+            raise CommandError(e)
+        self.stdout.write(self.style.SUCCESS(
+            'Generated ' + ', '.join(f'{amount} {name}' for name, amount in created.items())
+        ))
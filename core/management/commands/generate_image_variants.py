@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core.images import generate_variants
+from core.models import Profile, GroupChat
+
+
+class Command(BaseCommand):
+    help = 'Generate the missing resized variants of all profile and group chat images'
+
+    def handle(self, *args, **options):
+        names = set(Profile.objects.values_list('image', flat=True))
+        names |= set(GroupChat.objects.values_list('image', flat=True))
+        storage = Profile._meta.get_field('image').storage
+
+        for name in sorted(names):
+            if not name:
+                continue
+            try:
+                generate_variants(storage, name)
+            except (IOError, OSError) as exc:
+                self.stderr.write(f'Skipped {name}: {exc}')
+        self.stdout.write(self.style.SUCCESS(f'Generated variants of {len(names)} images'))
@@ -0,0 +1,22 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Profile, TimelineEntry
+
+
+class Command(BaseCommand):
+    help = 'Rebuild the fan-out timelines of the followers feed from the follows table'
+
+    def add_arguments(self, parser):
+        parser.add_argument('profile_ids', nargs='*', type=int, help='Profiles to rebuild, all by default')
+
+    def handle(self, *args, **options):
+        profiles = Profile.objects.all()
+        if options['profile_ids']:
+            profiles = profiles.filter(id__in=options['profile_ids'])
+
+        rebuilt = 0
+        for profile in profiles.only('id').iterator():
+            TimelineEntry.prune(profile.id)
+            TimelineEntry.backfill(profile.id, list(profile.follows.values_list('id', flat=True)))
+            rebuilt += 1
+        self.stdout.write(self.style.SUCCESS(f'Rebuilt timelines of {rebuilt} profiles'))
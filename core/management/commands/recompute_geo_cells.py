@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Profile
+
+
+class Command(BaseCommand):
+    help = 'Recompute the map grid cell of every located profile, needed after changing MAP_GRID_DEGREES'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        updated = Profile.refresh_geo_cells(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Updated the grid cell of {updated} profiles'))
@@ -0,0 +1,14 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Post
+
+
+class Command(BaseCommand):
+    help = 'Recompute Post.hot_score, writing only the posts whose score has changed'
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=1000)
+
+    def handle(self, *args, **options):
+        updated = Post.refresh_hot_scores(batch_size=options['batch_size'])
+        self.stdout.write(self.style.SUCCESS(f'Updated hot score of {updated} posts'))
@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from core.models import Profile
+
+
+class Command(BaseCommand):
+    help = 'Recompute the followers, following and posts counters of all profiles'
+
+    def handle(self, *args, **options):
+        updated = Profile.refresh_counters()
+        self.stdout.write(self.style.SUCCESS(f'Updated counters of {updated} profiles'))
@@ -0,0 +1,311 @@
+import bisect
+import json
+import logging
+import os
+import random
+import threading
+import time
+import uuid
+from contextlib import ExitStack
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.template.backends import django as django_backend
+
+from TamTut.settings import METRICS_SAMPLE_RATE, METRICS_LATENCY_BUCKETS, METRICS_LOG, METRICS_DIR, \
+    METRICS_FLUSH_INTERVAL
+from core.db_pool.pool import pool_counters, pool_gauges
+
+logger = logging.getLogger(__name__)
+
+_local = threading.local()
+
+
+class QueryCounter:
+    """Execute wrapper counting queries and their time, `connection.queries` is reset on every request."""
+
+    def __init__(self):
+        self.queries = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries += 1
+            self.seconds += time.perf_counter() - started
+
+
+class RequestSample:
+    def __init__(self):
+        self.db = QueryCounter()
+        self.template_seconds = 0.0
+
+
+class ViewMetrics:
+    def __init__(self, buckets):
+        self.bucket_counts = [0] * (len(buckets) + 1)
+        self.count = 0
+        self.seconds = 0.0
+        self.queries = 0
+        self.db_seconds = 0.0
+        self.template_seconds = 0.0
+
+
+class MetricsRegistry:
+    """Per URL name request metrics of this process: a latency histogram and DB and template totals."""
+
+    def __init__(self, buckets):
+        self.buckets = tuple(sorted(buckets))
+        self._views = {}
+        self._lock = threading.Lock()
+
+    def record(self, view, seconds, sample):
+        with self._lock:
+            metrics = self._views.get(view)
+            if metrics is None:
+                metrics = self._views[view] = ViewMetrics(self.buckets)
+            metrics.bucket_counts[bisect.bisect_left(self.buckets, seconds)] += 1
+            metrics.count += 1
+            metrics.seconds += seconds
+            metrics.queries += sample.db.queries
+            metrics.db_seconds += sample.db.seconds
+            metrics.template_seconds += sample.template_seconds
+
+    def clear(self):
+        with self._lock:
+            self._views.clear()
+
+    def totals(self):
+        """Per view totals of this process, in the form summed across workers by WorkerTotals."""
+        with self._lock:
+            return {view: dict(vars(metrics), bucket_counts=list(metrics.bucket_counts))
+                    for view, metrics in self._views.items()}
+
+    def render(self, totals=None):
+        """
+        The metrics in the Prometheus text exposition format, of `totals` as
+        collected from every worker by `worker_totals`, or of this process.
+        """
+        totals = self.totals() if totals is None else totals
+        lines = [
+            '# TYPE tamtut_request_duration_seconds histogram',
+            '# TYPE tamtut_request_queries_total counter',
+            '# TYPE tamtut_request_db_seconds_total counter',
+            '# TYPE tamtut_request_template_seconds_total counter',
+        ]
+        for view, metrics in sorted(totals.items()):
+            label = 'view="{}"'.format(view.replace('\\', '\\\\').replace('"', '\\"'))
+            cumulative = 0
+            for bound, amount in zip(self.buckets + ('+Inf',), metrics['bucket_counts']):
+                cumulative += amount
+                lines.append(f'tamtut_request_duration_seconds_bucket{{{label},le="{bound}"}} {cumulative}')
+            lines.append(f'tamtut_request_duration_seconds_sum{{{label}}} {metrics["seconds"]:.6f}')
+            lines.append(f'tamtut_request_duration_seconds_count{{{label}}} {metrics["count"]}')
+            lines.append(f'tamtut_request_queries_total{{{label}}} {metrics["queries"]}')
+            lines.append(f'tamtut_request_db_seconds_total{{{label}}} {metrics["db_seconds"]:.6f}')
+            lines.append(f'tamtut_request_template_seconds_total{{{label}}} {metrics["template_seconds"]:.6f}')
+        return '\n'.join(lines) + '\n'
+
+
+def merge_totals(first, second):
+    """Sum two totals made of dicts and lists of numbers, key by key and item by item."""
+    if isinstance(first, dict):
+        merged = dict(first)
+        for key, value in second.items():
+            merged[key] = merge_totals(merged[key], value) if key in merged else value
+        return merged
+    if isinstance(first, list):
+        return [merge_totals(one, other) for one, other in zip(first, second)]
+    return first + second
+
+
+def _read_json(path):
+    with open(path) as file:
+        return json.load(file)
+
+
+def _write_json(path, data):
+    # written under a temporary name and renamed into place, so a reader never sees half of it
+    temp_path = f'{path}.{uuid.uuid4().hex}.tmp'
+    with open(temp_path, 'w') as file:
+        json.dump(data, file)
+    os.replace(temp_path, path)
+
+
+class WorkerTotals:
+    """
+    Metrics totals of all gunicorn workers, so that whichever worker a scrape
+    reaches answers for every one of them with series that only ever grow.
+
+    Every process writes the totals of the registered sources to its own file
+    in `directory` every `interval` seconds. When a worker exits, the master
+    folds its counters into the archive and drops its gauges, see `fold`.
+    Without a directory only this process is counted.
+    """
+
+    ARCHIVE = 'archive.json'
+    # names of the files folded last: a reader that listed one before it was removed skips it
+    FOLDED_KEPT = 64
+
+    def __init__(self, directory, interval):
+        self.directory = directory
+        self.interval = interval
+        self._sources = {}
+        self._lock = threading.Lock()
+        self._started_pid = None
+        self._file_name = None
+
+    def register(self, name, source, gauge=False):
+        """`source()` returns the totals of this process under `name`; the gauges of exited workers are dropped."""
+        self._sources[name] = (source, gauge)
+
+    def own(self):
+        totals = {'counters': {}, 'gauges': {}}
+        for name, (source, gauge) in self._sources.items():
+            totals['gauges' if gauge else 'counters'][name] = source()
+        return totals
+
+    def start(self):
+        """Start writing the totals of this process in the background, once per process."""
+        if not self.directory or self._started_pid == os.getpid():
+            return
+        with self._lock:
+            if self._started_pid == os.getpid():
+                return
+            # the pid may be reused by a later worker, the name of a folded file must not
+            self._file_name = f'{os.getpid()}-{uuid.uuid4().hex}.json'
+            self._started_pid = os.getpid()
+        os.makedirs(self.directory, exist_ok=True)
+        threading.Thread(target=self._flush_periodically, name='metrics', daemon=True).start()
+
+    def _flush_periodically(self):
+        while True:
+            time.sleep(self.interval)
+            try:
+                self.flush()
+            except OSError:
+                logger.exception('Failed to write the metrics totals of this worker')
+
+    def flush(self):
+        if self.directory and self._started_pid == os.getpid():
+            _write_json(os.path.join(self.directory, self._file_name), self.own())
+
+    def _archive(self):
+        try:
+            return _read_json(os.path.join(self.directory, self.ARCHIVE))
+        except FileNotFoundError:
+            return {'counters': {}, 'folded': []}
+
+    def collect(self, name):
+        """The totals under `name` summed over the live workers, and over the exited ones for counters."""
+        kind = 'gauges' if self._sources[name][1] else 'counters'
+        if not self.directory:
+            return self.own()[kind][name]
+
+        self.start()
+        self.flush()
+        workers = []
+        for file_name in os.listdir(self.directory):
+            if file_name.endswith('.json') and file_name != self.ARCHIVE:
+                try:
+                    workers.append((file_name, _read_json(os.path.join(self.directory, file_name))))
+                except FileNotFoundError:
+                    # folded meanwhile, so it is in the archive read below
+                    continue
+        # read after the workers: a file folded meanwhile is counted either there or here, never in both
+        archive = self._archive()
+        totals = archive['counters'].get(name, {}) if kind == 'counters' else {}
+        for file_name, worker in workers:
+            if file_name not in archive['folded']:
+                totals = merge_totals(totals, worker[kind].get(name, {}))
+        return totals
+
+    def fold(self, pid):
+        """Keep the counters of an exited worker in the archive, called by the gunicorn master only."""
+        if not self.directory:
+            return
+        archive = self._archive()
+        folded = [file_name for file_name in os.listdir(self.directory) if file_name.startswith(f'{pid}-')
+                  and file_name.endswith('.json')]
+        for file_name in folded:
+            for name, totals in _read_json(os.path.join(self.directory, file_name))['counters'].items():
+                archive['counters'][name] = merge_totals(archive['counters'].get(name, {}), totals)
+        if folded:
+            archive['folded'] = (archive['folded'] + folded)[-self.FOLDED_KEPT:]
+            _write_json(os.path.join(self.directory, self.ARCHIVE), archive)
+            for file_name in folded:
+                os.remove(os.path.join(self.directory, file_name))
+
+
+registry = MetricsRegistry(METRICS_LATENCY_BUCKETS)
+worker_totals = WorkerTotals(METRICS_DIR, METRICS_FLUSH_INTERVAL)
+worker_totals.register('requests', registry.totals)
+worker_totals.register('db_pool', pool_counters)
+worker_totals.register('db_pool_gauges', pool_gauges, gauge=True)
+
+
+class RequestMetricsMiddleware:
+    """
+    Measures a METRICS_SAMPLE_RATE share of requests into `registry`, and logs
+    every sampled one as a JSON line when METRICS_LOG is set.
+    With a zero rate the middleware removes itself from the stack.
+    """
+
+    def __init__(self, get_response):
+        if METRICS_SAMPLE_RATE <= 0:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        if random.random() >= METRICS_SAMPLE_RATE:
+            return self.get_response(request)
+
+        sample = _local.sample = RequestSample()
+        started = time.perf_counter()
+        try:
+            with ExitStack() as stack:
+                for connection in connections.all():
+                    stack.enter_context(connection.execute_wrapper(sample.db))
+                response = self.get_response(request)
+        finally:
+            _local.sample = None
+        seconds = time.perf_counter() - started
+
+        match = request.resolver_match
+        view = match.view_name if match is not None else 'unresolved'
+        registry.record(view, seconds, sample)
+        if METRICS_LOG:
+            logger.info(json.dumps({
+                'view': view,
+                'method': request.method,
+                'status': response.status_code,
+                'ms': round(seconds * 1000, 2),
+                'queries': sample.db.queries,
+                'db_ms': round(sample.db.seconds * 1000, 2),
+                'template_ms': round(sample.template_seconds * 1000, 2),
+            }))
+        return response
+
+
+class Template(django_backend.Template):
+    def render(self, context=None, request=None):
+        sample = getattr(_local, 'sample', None)
+        if sample is None:
+            return super().render(context, request)
+        started = time.perf_counter()
+        try:
+            return super().render(context, request)
+        finally:
+            sample.template_seconds += time.perf_counter() - started
+
+
+class DjangoTemplates(django_backend.DjangoTemplates):
+    """The Django template backend, timing the templates rendered during a sampled request."""
+
+    def from_string(self, template_code):
+        return Template(super().from_string(template_code).template, self)
+
+    def get_template(self, template_name):
+        return Template(super().get_template(template_name).template, self)
@@ -0,0 +1,32 @@
+# Generated by Django 2.2.7 on 2026-10-18 12:25
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+
+
+def backfill_likes_count(apps, schema_editor):
+    Post = apps.get_model('core', 'Post')
+    likes = Post.liked_by.through.objects.filter(post=OuterRef('pk')).order_by().values('post')
+    likes = likes.annotate(amount=Count('pk')).values('amount')
+    Post.objects.update(likes_count=Coalesce(Subquery(likes, output_field=IntegerField()), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0021_auto_20200121_1956'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='likes_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['-likes_count', '-date_posted'], name='post_likes_count_idx'),
+        ),
+        migrations.RunPython(backfill_likes_count, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,38 @@
+# Generated by Django 2.2.7 on 2026-10-18 12:26
+
+import datetime
+import math
+
+from django.db import migrations, models
+
+from TamTut.settings import HOT_SCORE_DECAY_SECONDS
+
+
+def backfill_hot_score(apps, schema_editor):
+    Post = apps.get_model('core', 'Post')
+    epoch = datetime.datetime(2019, 12, 1, tzinfo=datetime.timezone.utc)
+    posts = list(Post.objects.only('id', 'likes_count', 'date_posted'))
+    for post in posts:
+        age = (post.date_posted - epoch).total_seconds()
+        post.hot_score = math.log10(max(post.likes_count, 1)) + age / HOT_SCORE_DECAY_SECONDS
+    Post.objects.bulk_update(posts, ['hot_score'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0022_post_likes_count'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='post',
+            name='hot_score',
+            field=models.FloatField(default=0),
+        ),
+        migrations.AddIndex(
+            model_name='post',
+            index=models.Index(fields=['-hot_score', '-id'], name='post_hot_score_idx'),
+        ),
+        migrations.RunPython(backfill_hot_score, migrations.RunPython.noop),
+    ]
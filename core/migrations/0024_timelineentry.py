@@ -0,0 +1,68 @@
+# Generated by Django 2.2.7 on 2026-10-18 12:26
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+from TamTut.settings import FANOUT_FOLLOWERS_LIMIT, TIMELINE_BACKFILL_POSTS
+
+
+# like TimelineEntry.backfill: the latest posts of every followed author, but none of a celebrity's,
+# which are merged into the feed on read; one INSERT ... SELECT per range of authors
+BACKFILL_SQL = """
+    INSERT INTO {timeline} (profile_id, post_id, date_posted)
+    SELECT follows.from_profile_id, latest.id, latest.date_posted
+    FROM {follows} follows
+    INNER JOIN (
+        SELECT id, author_id, date_posted,
+               ROW_NUMBER() OVER (PARTITION BY author_id ORDER BY date_posted DESC, id DESC) AS recency
+        FROM {post}
+        WHERE author_id >= %s AND author_id < %s
+    ) latest ON latest.author_id = follows.to_profile_id
+    WHERE latest.recency <= %s AND follows.to_profile_id NOT IN (
+        SELECT to_profile_id FROM {follows}
+        WHERE to_profile_id >= %s AND to_profile_id < %s
+        GROUP BY to_profile_id HAVING COUNT(*) > %s
+    )
+    ON CONFLICT DO NOTHING
+"""
+
+
+def backfill_timelines(apps, schema_editor, batch_size=1000):
+    Profile = apps.get_model('core', 'Profile')
+    Post = apps.get_model('core', 'Post')
+    TimelineEntry = apps.get_model('core', 'TimelineEntry')
+    sql = BACKFILL_SQL.format(timeline=TimelineEntry._meta.db_table, post=Post._meta.db_table,
+                              follows=Profile.follows.through._meta.db_table)
+    last_id = Profile.objects.aggregate(last_id=models.Max('id'))['last_id'] or 0
+    with schema_editor.connection.cursor() as cursor:
+        for first in range(1, last_id + 1, batch_size):
+            cursor.execute(sql, [first, first + batch_size, TIMELINE_BACKFILL_POSTS,
+                                 first, first + batch_size, FANOUT_FOLLOWERS_LIMIT])
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0023_post_hot_score'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='TimelineEntry',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('date_posted', models.DateTimeField()),
+                ('post', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline_entries', to='core.Post')),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='timeline', to='core.Profile')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='timelineentry',
+            index=models.Index(fields=['profile', '-date_posted', '-post'], name='timeline_profile_date_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='timelineentry',
+            unique_together={('profile', 'post')},
+        ),
+        migrations.RunPython(backfill_timelines, migrations.RunPython.noop),
+    ]
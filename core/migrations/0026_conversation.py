@@ -0,0 +1,64 @@
+# Generated by Django 2.2.7 on 2026-10-18 12:29
+
+from django.conf import settings
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+def backfill_conversations(apps, schema_editor):
+    Message = apps.get_model('core', 'Message')
+    GroupChat = apps.get_model('core', 'GroupChat')
+    Conversation = apps.get_model('core', 'Conversation')
+
+    # the latest message wins, so walk the history from the newest one
+    direct = {}
+    for msg in Message.objects.filter(group_chat_in=None).order_by('-date_sent').iterator():
+        for user_id, peer_id in ((msg.sender_id, msg.receiver_id), (msg.receiver_id, msg.sender_id)):
+            direct.setdefault((user_id, peer_id), msg)
+    conversations = [
+        Conversation(user_id=user_id, peer_id=peer_id, last_message=msg, preview=msg.msg_text[:100],
+                     date_last=msg.date_sent)
+        for (user_id, peer_id), msg in direct.items()
+    ]
+
+    for group_chat in GroupChat.objects.all():
+        msg = Message.objects.filter(group_chat_in=group_chat).order_by('-date_sent').first()
+        for user in group_chat.chat_users.all():
+            conversations.append(Conversation(
+                user=user, group_chat=group_chat, last_message=msg,
+                preview=msg.msg_text[:100] if msg else '',
+                date_last=msg.date_sent if msg else group_chat.date_created,
+            ))
+    Conversation.objects.bulk_create(conversations, batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        migrations.swappable_dependency(settings.AUTH_USER_MODEL),
+        ('core', '0025_post_keyset_indexes'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Conversation',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('preview', models.CharField(blank=True, max_length=100)),
+                ('date_last', models.DateTimeField()),
+                ('group_chat', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to='core.GroupChat')),
+                ('last_message', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='core.Message')),
+                ('peer', models.ForeignKey(default=None, null=True, on_delete=django.db.models.deletion.CASCADE, related_name='+', to=settings.AUTH_USER_MODEL)),
+                ('user', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='conversations', to=settings.AUTH_USER_MODEL)),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='conversation',
+            index=models.Index(fields=['user', '-date_last', '-id'], name='conversation_user_date_idx'),
+        ),
+        migrations.AlterUniqueTogether(
+            name='conversation',
+            unique_together={('user', 'peer'), ('user', 'group_chat')},
+        ),
+        migrations.RunPython(backfill_conversations, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 2.2.7 on 2026-10-18 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0026_conversation'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['sender', 'receiver', '-date_sent', '-id'], name='message_dialog_date_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['group_chat_in', '-date_sent', '-id'], name='message_group_date_idx'),
+        ),
+    ]
@@ -0,0 +1,41 @@
+# Generated by Django 2.2.7 on 2026-10-18 12:31
+
+import math
+
+from django.db import migrations, models
+
+# frozen copy of core.geo.grid_cell with the default MAP_GRID_DEGREES, so replaying the migration
+# always gives the same cells; after changing the setting run `python manage.py recompute_geo_cells`
+GRID_DEGREES = 0.05
+GRID_ROWS = math.ceil(180 / GRID_DEGREES)
+GRID_COLUMNS = math.ceil(360 / GRID_DEGREES)
+
+
+def grid_cell(lat, lng):
+    row = min(max(int((lat + 90) // GRID_DEGREES), 0), GRID_ROWS - 1)
+    column = min(max(int((lng + 180) // GRID_DEGREES), 0), GRID_COLUMNS - 1)
+    return row * GRID_COLUMNS + column
+
+
+def backfill_geo_cell(apps, schema_editor):
+    Profile = apps.get_model('core', 'Profile')
+    profiles = list(Profile.objects.exclude(latitude=None).exclude(longitude=None).only('id', 'latitude', 'longitude'))
+    for profile in profiles:
+        profile.geo_cell = grid_cell(profile.latitude, profile.longitude)
+    Profile.objects.bulk_update(profiles, ['geo_cell'], batch_size=1000)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0027_message_history_indexes'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='geo_cell',
+            field=models.IntegerField(blank=True, db_index=True, default=None, editable=False, null=True),
+        ),
+        migrations.RunPython(backfill_geo_cell, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 2.2.7 on 2026-10-18 12:33
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0028_profile_geo_cell'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SimilarProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('score', models.FloatField()),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='similar_profiles', to='core.Profile')),
+                ('similar', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Profile')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='similarprofile',
+            index=models.Index(fields=['profile', '-score'], name='similar_profile_score_idx'),
+        ),
+    ]
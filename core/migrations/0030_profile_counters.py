@@ -0,0 +1,47 @@
+# Generated by Django 2.2.7 on 2026-10-18 12:39
+
+from django.db import migrations, models
+from django.db.models import Count, OuterRef, Subquery, IntegerField
+from django.db.models.functions import Coalesce
+
+
+def backfill_profile_counters(apps, schema_editor):
+    Profile = apps.get_model('core', 'Profile')
+    Post = apps.get_model('core', 'Post')
+    follows = Profile.follows.through.objects.order_by()
+    sources = {
+        'followers_count': follows.filter(to_profile=OuterRef('pk')).values('to_profile'),
+        'following_count': follows.filter(from_profile=OuterRef('pk')).values('from_profile'),
+        'posts_count': Post.objects.order_by().filter(author=OuterRef('pk')).values('author'),
+    }
+    Profile.objects.update(**{
+        field: Coalesce(Subquery(source.annotate(amount=Count('pk')).values('amount'),
+                                 output_field=IntegerField()), 0)
+        for field, source in sources.items()
+    })
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0029_similarprofile'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='profile',
+            name='followers_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='following_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='profile',
+            name='posts_count',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.RunPython(backfill_profile_counters, migrations.RunPython.noop),
+    ]
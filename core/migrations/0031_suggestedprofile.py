@@ -0,0 +1,29 @@
+# Generated by Django 2.2.7 on 2026-10-18 12:42
+
+from django.db import migrations, models
+import django.db.models.deletion
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('core', '0030_profile_counters'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='SuggestedProfile',
+            fields=[
+                ('id', models.AutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('mutual_follows', models.PositiveIntegerField()),
+                ('shared_hobbies', models.PositiveIntegerField()),
+                ('score', models.FloatField()),
+                ('profile', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='suggested_profiles', to='core.Profile')),
+                ('suggested', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, related_name='+', to='core.Profile')),
+            ],
+        ),
+        migrations.AddIndex(
+            model_name='suggestedprofile',
+            index=models.Index(fields=['profile', '-score'], name='suggested_profile_score_idx'),
+        ),
+    ]
@@ -1,8 +1,83 @@
-from PIL import Image
-from django.db import models
+import datetime
+import math
+
+from django.db import models, transaction
 from django.contrib.auth.models import User
-from django.db.models import Q
+from django.db.models import Q, F, Count, Exists, OuterRef, Subquery, IntegerField
+from django.db.models.fields.files import FieldFile
+from django.db.models.functions import Coalesce, Greatest, Log
 from django.shortcuts import reverse
+from django.utils import dateformat, timezone
+
+from core.geo import grid_cell, viewport_cells, in_viewport
+from core.images import schedule_variants, has_variants, variant_url
+from TamTut.settings import HOT_SCORE_DECAY_SECONDS, FANOUT_FOLLOWERS_LIMIT, TIMELINE_BACKFILL_POSTS
+
+# reference point of the hot score time term, keeps the stored scores small
+HOT_SCORE_EPOCH = datetime.datetime(2019, 12, 1, tzinfo=datetime.timezone.utc)
+
+
+def schedule_missing_variants(image):
+    # resizing happens off the request, once the uploaded original is committed
+    if image and not has_variants(image):
+        transaction.on_commit(lambda: schedule_variants(image))
+
+
+class TrackChangesMixin:
+    """
+    Remembers the field values loaded from the database, so `save` writes
+    only the fields that changed since and skips the UPDATE when none did.
+    """
+
+    @classmethod
+    def from_db(cls, db, field_names, values):
+        instance = super().from_db(db, field_names, values)
+        instance._loaded_values = {
+            name: value for name, value in zip(field_names, values) if value is not models.DEFERRED
+        }
+        return instance
+
+    def _current_value(self, field):
+        value = getattr(self, field.attname)
+        return value.name if isinstance(value, FieldFile) else value
+
+    def changed_fields(self):
+        loaded_values = getattr(self, '_loaded_values', None)
+        if self._state.adding or loaded_values is None:
+            return None
+        deferred = self.get_deferred_fields()
+        # a deferred field assigned without being loaded counts as changed
+        return [
+            field.attname for field in self._meta.concrete_fields
+            if field.attname not in deferred and (field.attname not in loaded_values or
+                                                  self._current_value(field) != loaded_values[field.attname])
+        ]
+
+    def save(self, *args, **kwargs):
+        changed = self.changed_fields()
+        if changed is not None and not args and not kwargs:
+            if not changed:
+                return
+            kwargs['update_fields'] = changed
+        super().save(*args, **kwargs)
+        self._remember_values()
+
+    def refresh_from_db(self, using=None, fields=None):
+        super().refresh_from_db(using, fields)
+        # deferred fields are loaded through here too
+        self._remember_values(fields)
+
+    def _remember_values(self, fields=None):
+        if fields is None:
+            deferred = self.get_deferred_fields()
+            attnames = [field.attname for field in self._meta.concrete_fields if field.attname not in deferred]
+        else:
+            attnames = [self._meta.get_field(name).attname for name in fields]
+        loaded_values = getattr(self, '_loaded_values', None) or {}
+        for field in self._meta.concrete_fields:
+            if field.attname in attnames:
+                loaded_values[field.attname] = self._current_value(field)
+        self._loaded_values = loaded_values
 
 
 class Hobby(models.Model):
@@ -12,7 +87,7 @@ class Hobby(models.Model):
         return self.name
 
 
-class Profile(models.Model):
+class Profile(TrackChangesMixin, models.Model):
     user = models.OneToOneField(User, on_delete=models.CASCADE)
     hobby = models.ManyToManyField(Hobby)
     image = models.ImageField(default='default.jpg', upload_to='profile_pics')
@@ -20,28 +95,120 @@ class Profile(models.Model):
     latitude = models.FloatField(null=True, default=None, blank=True)
     longitude = models.FloatField(null=True, default=None, blank=True)
 
+    # map grid bucket of (latitude, longitude), see core.geo
+    geo_cell = models.IntegerField(null=True, default=None, blank=True, db_index=True, editable=False)
+
     follows = models.ManyToManyField("self", related_name="followed_by", symmetrical=False)
 
+    # denormalized counters, kept in sync by core.signals and repaired by repair_profile_counters
+    followers_count = models.PositiveIntegerField(default=0)
+    following_count = models.PositiveIntegerField(default=0)
+    posts_count = models.PositiveIntegerField(default=0)
+
     def __str__(self):
         return f'{self.user.username} Profile'
 
+    def is_following(self, profile):
+        return Profile.follows.through.objects.filter(from_profile=self, to_profile=profile).exists()
+
+    @staticmethod
+    def refresh_counters(profiles=None, fields=('followers_count', 'following_count', 'posts_count')):
+        """Recompute the counters of `profiles` from the follows and posts tables in one UPDATE."""
+        follows = Profile.follows.through.objects.order_by()
+        sources = {
+            'followers_count': follows.filter(to_profile=OuterRef('pk')).values('to_profile'),
+            'following_count': follows.filter(from_profile=OuterRef('pk')).values('from_profile'),
+            'posts_count': Post.objects.order_by().filter(author=OuterRef('pk')).values('author'),
+        }
+        counters = {}
+        for field in fields:
+            amount = sources[field].annotate(amount=Count('pk')).values('amount')
+            counters[field] = Coalesce(Subquery(amount, output_field=IntegerField()), 0)
+        if profiles is None:
+            profiles = Profile.objects.all()
+        return profiles.update(**counters)
+
     @staticmethod
     def filter_by_hobbies(hobbies):
-        hobbies = hobbies
-        matched_profiles = Profile.objects.all()
-        for hobby in hobbies:
-            matched_profiles = matched_profiles.filter(hobby__name=hobby)
-        return matched_profiles
+        """Profiles having every one of `hobbies`, as one grouped query instead of a join per hobby."""
+        hobbies = set(hobbies)
+        if not hobbies:
+            return Profile.objects.all()
+        matched_profiles = Profile.objects.filter(hobby__in=hobbies).annotate(matched_hobbies=Count('hobby'))
+        return matched_profiles.filter(matched_hobbies=len(hobbies))
+
+    @staticmethod
+    def filter_by_any_hobby(hobbies):
+        return Profile.objects.filter(id__in=Profile.hobby.through.objects.filter(hobby__in=hobbies).values('profile'))
+
+    @staticmethod
+    def refresh_geo_cells(batch_size=1000):
+        """Recompute `geo_cell` for the current grid size and write back only the profiles whose cell changed."""
+        profiles = Profile.objects.only('id', 'latitude', 'longitude', 'geo_cell').order_by('id')
+        changed = []
+        updated = 0
+        for profile in profiles.iterator(chunk_size=batch_size):
+            cell = grid_cell(profile.latitude, profile.longitude)
+            if cell != profile.geo_cell:
+                profile.geo_cell = cell
+                changed.append(profile)
+            if len(changed) >= batch_size:
+                Profile.objects.bulk_update(changed, ['geo_cell'])
+                updated += len(changed)
+                changed = []
+        if changed:
+            Profile.objects.bulk_update(changed, ['geo_cell'])
+            updated += len(changed)
+        return updated
+
+    @staticmethod
+    def in_viewport(south, west, north, east):
+        return Profile.objects.filter(viewport_cells(south, west, north, east), in_viewport(south, west, north, east))
 
     def save(self, *args, **kwargs):
+        self.geo_cell = grid_cell(self.latitude, self.longitude)
+        changed = self.changed_fields()
         super(Profile, self).save(*args, **kwargs)
+        if changed is None or 'image' in changed:
+            schedule_missing_variants(self.image)
+
+
+class SimilarProfile(models.Model):
+    """Precomputed top neighbours of `profile` by Jaccard similarity of hobbies, see core.similarity."""
+    profile = models.ForeignKey(Profile, related_name='similar_profiles', on_delete=models.CASCADE)
+    similar = models.ForeignKey(Profile, related_name='+', on_delete=models.CASCADE)
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['profile', '-score'], name='similar_profile_score_idx'),
+        ]
+
+    @staticmethod
+    def most_similar(profile):
+        similar = SimilarProfile.objects.filter(profile=profile).select_related('similar__user')
+        return similar.order_by('-score', 'similar_id')
 
-        img = Image.open(self.image.path)
 
-        if img.height > 300 or img.width > 300:
-            output_size = (300, 300)
-            img.thumbnail(output_size)
-            img.save(self.image.path)
+class SuggestedProfile(models.Model):
+    """Precomputed "who to follow" suggestion for `profile` from the friends-of-friends graph, see core.suggestions."""
+    profile = models.ForeignKey(Profile, related_name='suggested_profiles', on_delete=models.CASCADE)
+    suggested = models.ForeignKey(Profile, related_name='+', on_delete=models.CASCADE)
+    # profiles followed by `profile` that follow `suggested`
+    mutual_follows = models.PositiveIntegerField()
+    shared_hobbies = models.PositiveIntegerField()
+    score = models.FloatField()
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['profile', '-score'], name='suggested_profile_score_idx'),
+        ]
+
+    @staticmethod
+    def for_profile(profile):
+        # profiles followed since the suggestions were computed are left out
+        suggested = SuggestedProfile.objects.filter(profile=profile).exclude(suggested__in=profile.follows.all())
+        return suggested.select_related('suggested__user').order_by('-score', 'suggested_id')
 
 
 class Post(models.Model):
@@ -51,6 +218,22 @@ class Post(models.Model):
     date_posted = models.DateTimeField(auto_now_add=True)
 
     liked_by = models.ManyToManyField(Profile, related_name="liked")
+    # denormalized `liked_by` count, kept in sync by the m2m_changed signal in core.signals
+    likes_count = models.PositiveIntegerField(default=0)
+    # time-decayed ranking of the hot feed, changes only when `likes_count` does
+    hot_score = models.FloatField(default=0)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=['-likes_count', '-date_posted', '-id'], name='post_likes_count_idx'),
+            models.Index(fields=['-hot_score', '-id'], name='post_hot_score_idx'),
+            models.Index(fields=['author', '-date_posted', '-id'], name='post_author_date_idx'),
+        ]
+
+    def save(self, *args, **kwargs):
+        if self.pk is None:
+            self.hot_score = Post.compute_hot_score(self.likes_count, self.date_posted or timezone.now())
+        super(Post, self).save(*args, **kwargs)
 
     def like_post(self):
         return reverse('like_post', kwargs={
@@ -67,12 +250,133 @@ class Post(models.Model):
 
     @property
     def likes_amount(self):
-        return self.liked_by.count()
+        return self.likes_count
+
+    @staticmethod
+    def for_viewer(posts, viewer_profile):
+        """
+        Load what a rendered post card needs in the same query as the posts:
+        the author with its user, and `is_liked` by the current viewer.
+        """
+        viewer_likes = Post.liked_by.through.objects.filter(post=OuterRef('pk'), profile=viewer_profile)
+        return posts.select_related('author__user').annotate(is_liked=Exists(viewer_likes))
+
+    @staticmethod
+    def refresh_likes_count(posts=None):
+        """Recompute `likes_count` from the `liked_by` table in one UPDATE."""
+        likes = Post.liked_by.through.objects.filter(post=OuterRef('pk')).order_by().values('post')
+        likes = likes.annotate(amount=Count('pk')).values('amount')
+        if posts is None:
+            posts = Post.objects.all()
+        return posts.update(likes_count=Coalesce(Subquery(likes, output_field=IntegerField()), 0))
+
+    @staticmethod
+    def compute_hot_score(likes_count, date_posted):
+        # newer posts get a linearly growing bonus, so scores of old posts never have to be decayed
+        age = (date_posted - HOT_SCORE_EPOCH).total_seconds()
+        return math.log10(max(likes_count, 1)) + age / HOT_SCORE_DECAY_SECONDS
+
+    @staticmethod
+    def likes_count_update(likes_count):
+        """
+        update() arguments setting `likes_count` to the expression `likes_count` and
+        moving `hot_score` along in the same UPDATE: only its likes term changes, and
+        the right-hand sides of an UPDATE all see the row as it was before.
+        """
+        return {
+            'likes_count': likes_count,
+            'hot_score': F('hot_score') + Log(10, Greatest(likes_count, 1)) - Log(10, Greatest(F('likes_count'), 1)),
+        }
+
+    @staticmethod
+    def refresh_hot_scores(posts=None, batch_size=1000):
+        """Recompute `hot_score` and write back only the posts whose score has changed."""
+        if posts is None:
+            posts = Post.objects.all()
+        posts = posts.only('id', 'likes_count', 'date_posted', 'hot_score').order_by('id')
+
+        changed = []
+        updated = 0
+        for post in posts.iterator(chunk_size=batch_size):
+            score = Post.compute_hot_score(post.likes_count, post.date_posted)
+            if not math.isclose(score, post.hot_score):
+                post.hot_score = score
+                changed.append(post)
+            if len(changed) >= batch_size:
+                Post.objects.bulk_update(changed, ['hot_score'])
+                updated += len(changed)
+                changed = []
+        if changed:
+            Post.objects.bulk_update(changed, ['hot_score'])
+            updated += len(changed)
+        return updated
 
     def __str__(self):
         return f'By {self.author.user.username} - {self.text[:10]}'
 
 
+class TimelineEntry(models.Model):
+    """A post pushed into the followers feed of `profile` when it was written (fan-out on write)."""
+    profile = models.ForeignKey(Profile, related_name='timeline', on_delete=models.CASCADE)
+    post = models.ForeignKey(Post, related_name='timeline_entries', on_delete=models.CASCADE)
+    date_posted = models.DateTimeField()
+
+    class Meta:
+        unique_together = ('profile', 'post')
+        indexes = [
+            models.Index(fields=['profile', '-date_posted', '-post'], name='timeline_profile_date_idx'),
+        ]
+
+    @staticmethod
+    def celebrities(profiles):
+        # authors that are read on demand instead of being fanned out
+        return profiles.filter(followers_count__gt=FANOUT_FOLLOWERS_LIMIT)
+
+    @staticmethod
+    def feed(profile):
+        celebrities = list(TimelineEntry.celebrities(profile.follows.all()).values_list('id', flat=True))
+        if not celebrities:
+            # walks the (profile, -date_posted, -post) index of the timeline
+            feed = Post.objects.filter(timeline_entries__profile=profile)
+            feed = feed.annotate(feed_date=F('timeline_entries__date_posted'))
+        else:
+            timeline_posts = TimelineEntry.objects.filter(profile=profile).values('post')
+            feed = Post.objects.filter(Q(id__in=timeline_posts) | Q(author__in=celebrities))
+            feed = feed.annotate(feed_date=F('date_posted'))
+        return feed.order_by('-feed_date', '-id')
+
+    @staticmethod
+    def fan_out(post):
+        # the author instance may hold a counter read before the latest follows
+        if TimelineEntry.celebrities(Profile.objects.filter(pk=post.author_id)).exists():
+            return
+        followers = Profile.objects.filter(follows=post.author_id)
+        TimelineEntry.objects.bulk_create([
+            TimelineEntry(profile_id=follower_id, post_id=post.pk, date_posted=post.date_posted)
+            for follower_id in followers.values_list('id', flat=True)
+        ], batch_size=1000, ignore_conflicts=True)
+
+    @staticmethod
+    def backfill(follower_id, followed_ids):
+        followed = TimelineEntry.celebrities(Profile.objects.filter(id__in=followed_ids))
+        followed_ids = set(followed_ids) - set(followed.values_list('id', flat=True))
+        entries = []
+        for followed_id in followed_ids:
+            posts = Post.objects.filter(author_id=followed_id).order_by('-date_posted')[:TIMELINE_BACKFILL_POSTS]
+            entries.extend(
+                TimelineEntry(profile_id=follower_id, post_id=post_id, date_posted=date_posted)
+                for post_id, date_posted in posts.values_list('id', 'date_posted')
+            )
+        TimelineEntry.objects.bulk_create(entries, batch_size=1000, ignore_conflicts=True)
+
+    @staticmethod
+    def prune(follower_id, followed_ids=None):
+        entries = TimelineEntry.objects.filter(profile_id=follower_id)
+        if followed_ids is not None:
+            entries = entries.filter(post__author_id__in=followed_ids)
+        entries.delete()
+
+
 class Message(models.Model):
     sender = models.ForeignKey(User, related_name="sent_by", on_delete=models.CASCADE)
     receiver = models.ForeignKey(User, related_name="received_by", default=None, null=True, on_delete=models.CASCADE)
@@ -82,11 +386,34 @@ class Message(models.Model):
     group_chat_in = models.ForeignKey('GroupChat', related_name='group_msgs', default=None, null=True,
                                       on_delete=models.CASCADE)
 
+    class Meta:
+        indexes = [
+            models.Index(fields=['sender', 'receiver', '-date_sent', '-id'], name='message_dialog_date_idx'),
+            models.Index(fields=['group_chat_in', '-date_sent', '-id'], name='message_group_date_idx'),
+        ]
+
     @staticmethod
     def user_msgs(user):
         # not fetching group messages
         return Message.objects.filter(Q(sender=user) | Q(receiver=user), group_chat_in=None).order_by('-date_sent')
 
+    @staticmethod
+    def dialog_msgs(user, interlocutor):
+        dialog = Q(sender=user, receiver=interlocutor) | Q(sender=interlocutor, receiver=user)
+        return Message.objects.filter(dialog, group_chat_in=None)
+
+    def as_dict(self):
+        return {
+            'id': self.id,
+            'sender_id': self.sender_id,
+            'sender_username': self.sender.username,
+            'sender_profile_url': reverse('profile', args=[self.sender_id]),
+            'sender_image_url': variant_url(self.sender.profile.image, 40),
+            'msg_text': self.msg_text,
+            'date_sent': self.date_sent.isoformat(),
+            'date_sent_display': dateformat.format(timezone.localtime(self.date_sent), 'H:i jS M Y'),
+        }
+
     def __str__(self):
         return self.msg_text
 
@@ -98,5 +425,66 @@ class GroupChat(models.Model):
     image = models.ImageField(default='default.jpg', upload_to='profile_pics')
     date_created = models.DateTimeField(auto_now_add=True)
 
+    def save(self, *args, **kwargs):
+        super(GroupChat, self).save(*args, **kwargs)
+        schedule_missing_variants(self.image)
+
     def __str__(self):
         return self.chat_title
+
+
+class Conversation(models.Model):
+    """Chat sidebar entry of `user`: one row per interlocutor or group chat, kept up to date on every message."""
+    user = models.ForeignKey(User, related_name='conversations', on_delete=models.CASCADE)
+    peer = models.ForeignKey(User, related_name='+', default=None, null=True, on_delete=models.CASCADE)
+    group_chat = models.ForeignKey(GroupChat, related_name='conversations', default=None, null=True,
+                                   on_delete=models.CASCADE)
+    last_message = models.ForeignKey(Message, related_name='+', default=None, null=True,
+                                     on_delete=models.SET_NULL)
+    preview = models.CharField(max_length=100, blank=True)
+    date_last = models.DateTimeField()
+
+    class Meta:
+        unique_together = (('user', 'peer'), ('user', 'group_chat'))
+        indexes = [
+            models.Index(fields=['user', '-date_last', '-id'], name='conversation_user_date_idx'),
+        ]
+
+    @property
+    def object(self):
+        return self.group_chat if self.group_chat_id is not None else self.peer
+
+    @staticmethod
+    def sidebar(user):
+        return Conversation.objects.filter(user=user).select_related('peer__profile', 'group_chat')
+
+    @staticmethod
+    def register_message(message):
+        fields = {
+            'last_message': message,
+            'preview': message.msg_text[:100],
+            'date_last': message.date_sent,
+        }
+        if message.group_chat_in_id is not None:
+            Conversation.objects.filter(group_chat_id=message.group_chat_in_id).update(**fields)
+        else:
+            Conversation.objects.update_or_create(user_id=message.sender_id, peer_id=message.receiver_id,
+                                                  defaults=fields)
+            if message.receiver_id != message.sender_id:
+                Conversation.objects.update_or_create(user_id=message.receiver_id, peer_id=message.sender_id,
+                                                      defaults=fields)
+
+    @staticmethod
+    def join_group_chat(group_chat, user_ids):
+        last_message = group_chat.group_msgs.order_by('-date_sent').first()
+        Conversation.objects.bulk_create([
+            Conversation(
+                user_id=user_id, group_chat=group_chat, last_message=last_message,
+                preview=last_message.msg_text[:100] if last_message else '',
+                date_last=last_message.date_sent if last_message else group_chat.date_created,
+            ) for user_id in user_ids
+        ], ignore_conflicts=True)
+
+    @staticmethod
+    def leave_group_chat(group_chat_ids, user_ids):
+        Conversation.objects.filter(group_chat_id__in=group_chat_ids, user_id__in=user_ids).delete()
@@ -0,0 +1,49 @@
+import threading
+import time
+
+
+class MessageNotifier:
+    """
+    In-process pub/sub for new chat messages.
+
+    Every conversation key has a version counter that is bumped on `notify`;
+    a waiter remembers the version it has seen before querying and sleeps
+    until it changes, so a message saved between the query and the wait is
+    never missed. Only waiters of the same process are woken up, the ones in
+    other gunicorn workers notice new messages on their next poll interval.
+    """
+
+    def __init__(self):
+        self._condition = threading.Condition()
+        self._versions = {}
+
+    def version(self, key):
+        with self._condition:
+            return self._versions.get(key, 0)
+
+    def notify(self, key):
+        with self._condition:
+            self._versions[key] = self._versions.get(key, 0) + 1
+            self._condition.notify_all()
+
+    def wait(self, key, seen_version, timeout):
+        """Block until `key` moves past `seen_version` or `timeout` runs out, return whether it did."""
+        deadline = time.monotonic() + timeout
+        with self._condition:
+            while self._versions.get(key, 0) == seen_version:
+                remaining = deadline - time.monotonic()
+                if remaining <= 0:
+                    return False
+                self._condition.wait(remaining)
+            return True
+
+
+def dialog_key(user_id, interlocutor_id):
+    return f'dialog:{min(user_id, interlocutor_id)}:{max(user_id, interlocutor_id)}'
+
+
+def group_chat_key(group_chat_id):
+    return f'group:{group_chat_id}'
+
+
+message_notifier = MessageNotifier()
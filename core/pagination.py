@@ -0,0 +1,149 @@
+import base64
+import binascii
+import datetime
+import json
+
+from django.core.exceptions import ValidationError
+from django.db.models import Q
+from django.http import Http404
+
+
+class CursorPage:
+    """One page of a keyset paginated queryset with opaque tokens of the neighbouring pages."""
+
+    def __init__(self, object_list, next_cursor, previous_cursor):
+        self.object_list = object_list
+        self.next_cursor = next_cursor
+        self.previous_cursor = previous_cursor
+
+    def has_next(self):
+        return self.next_cursor is not None
+
+    def has_previous(self):
+        return self.previous_cursor is not None
+
+    def has_other_pages(self):
+        return self.has_next() or self.has_previous()
+
+    def __iter__(self):
+        return iter(self.object_list)
+
+    def __len__(self):
+        return len(self.object_list)
+
+    def __getitem__(self, index):
+        return self.object_list[index]
+
+
+class CursorPaginator:
+    """
+    Paginates a queryset by the values of its ordering key instead of OFFSET,
+    so the cost of a page doesn't depend on how deep it is and no COUNT is run.
+
+    `ordering` must be unique over the queryset (end it with the primary key) and
+    name plain attributes of the returned objects (annotate joined fields first).
+    """
+
+    def __init__(self, objects, ordering, per_page):
+        self.objects = objects
+        self.ordering = tuple(ordering)
+        self.per_page = int(per_page)
+
+    def get_page(self, cursor):
+        position = self.decode_cursor(cursor)
+        if position is None:
+            values, backwards = None, False
+        else:
+            values, backwards = position
+
+        ordering = self.ordering
+        if backwards:
+            ordering = tuple(self._reverse(field) for field in ordering)
+
+        objects = self.objects.order_by(*ordering)
+        if values is not None:
+            objects = objects.filter(self._after(ordering, values))
+        object_list = list(objects[:self.per_page + 1])
+
+        has_more = len(object_list) > self.per_page
+        object_list = object_list[:self.per_page]
+        if backwards:
+            object_list.reverse()
+
+        # coming from a neighbouring page means there is one in that direction
+        if backwards:
+            has_next, has_previous = True, has_more
+        else:
+            has_next, has_previous = has_more, values is not None
+
+        next_cursor = previous_cursor = None
+        if object_list and has_next:
+            next_cursor = self.encode_cursor(self._key(object_list[-1]), False)
+        if object_list and has_previous:
+            previous_cursor = self.encode_cursor(self._key(object_list[0]), True)
+        return CursorPage(object_list, next_cursor, previous_cursor)
+
+    def _key(self, obj):
+        return [getattr(obj, field.lstrip('-')) for field in self.ordering]
+
+    @staticmethod
+    def _reverse(field):
+        return field[1:] if field.startswith('-') else '-' + field
+
+    @staticmethod
+    def _after(ordering, values):
+        # (a, b) > (x, y) expanded into a > x OR (a = x AND b > y), with per-field direction
+        condition = Q()
+        equal = Q()
+        for field, value in zip(ordering, values):
+            name = field.lstrip('-')
+            lookup = 'lt' if field.startswith('-') else 'gt'
+            condition |= equal & Q(**{f'{name}__{lookup}': value})
+            equal &= Q(**{name: value})
+        return condition
+
+    @staticmethod
+    def encode_cursor(values, backwards):
+        values = [value.isoformat() if isinstance(value, datetime.datetime) else value for value in values]
+        data = json.dumps({'v': values, 'b': backwards}, separators=(',', ':'))
+        return base64.urlsafe_b64encode(data.encode()).decode().rstrip('=')
+
+    def _field(self, name):
+        annotation = self.objects.query.annotations.get(name)
+        if annotation is not None:
+            return annotation.output_field
+        return self.objects.model._meta.get_field(name)
+
+    def decode_cursor(self, cursor):
+        """
+        The (values, backwards) position of a token, with every value converted by
+        its ordering field; a token that can't be read raises Http404, like an
+        out of range page number does in Django's ListView.
+        """
+        if not cursor:
+            return None
+        try:
+            data = base64.urlsafe_b64decode(cursor + '=' * (-len(cursor) % 4))
+            data = json.loads(data.decode())
+            values, backwards = data['v'], data['b']
+            if not isinstance(values, list) or len(values) != len(self.ordering) or not isinstance(backwards, bool):
+                raise ValueError
+            values = [self._field(field.lstrip('-')).to_python(value) for field, value in zip(self.ordering, values)]
+            if None in values:
+                raise ValueError
+        except (ValueError, TypeError, KeyError, binascii.Error, ValidationError):
+            raise Http404('Invalid cursor')
+        return values, backwards
+
+
+def cursor_paginate(request, objects, ordering, num_of_elements):
+    return CursorPaginator(objects, ordering, num_of_elements).get_page(request.GET.get('cursor'))
+
+
+class CursorPaginationMixin:
+    """Makes a ListView paginate by `cursor_ordering` keyset instead of page numbers."""
+    cursor_ordering = ('-id',)
+
+    def paginate_queryset(self, queryset, page_size):
+        page = cursor_paginate(self.request, queryset, self.cursor_ordering, page_size)
+        return None, page, page.object_list, page.has_other_pages()
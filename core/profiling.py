@@ -0,0 +1,124 @@
+import cProfile
+import json
+import os
+import random
+import re
+import time
+import uuid
+from contextlib import ExitStack
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+from django.utils import timezone
+
+from TamTut.settings import PROFILING_ENABLED, PROFILING_SAMPLE_RATE, PROFILING_DIR, PROFILING_KEEP
+
+PROFILE_HEADER = 'HTTP_X_PROFILE'
+PROFILE_PARAM = 'profile'
+# names of saved profiles, also guards the download view against paths
+PROFILE_NAME = re.compile(r'^\d{8}-\d{6}-[\w.-]+-[0-9a-f]{8}$')
+
+
+class SQLRecorder:
+    """Execute wrapper keeping the SQL and time of every query; parameters hold user data and are left out."""
+
+    def __init__(self):
+        self.queries = []
+
+    def __call__(self, execute, sql, params, many, context):
+        started = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.queries.append({
+                'sql': sql,
+                'ms': round((time.perf_counter() - started) * 1000, 3),
+            })
+
+
+def is_requested(request):
+    """A profile asked for with the X-Profile header or the ?profile flag, honoured for staff only."""
+    if PROFILE_HEADER not in request.META and PROFILE_PARAM not in request.GET:
+        return False
+    return request.user.is_authenticated and request.user.is_staff
+
+
+def save_profile(profiler, recorder, request, response, seconds):
+    match = request.resolver_match
+    view = match.view_name if match is not None else 'unresolved'
+    name = '{}-{}-{}'.format(timezone.now().strftime('%Y%m%d-%H%M%S'), re.sub(r'[^\w.-]', '_', view),
+                             uuid.uuid4().hex[:8])
+    os.makedirs(PROFILING_DIR, exist_ok=True)
+    profiler.dump_stats(os.path.join(PROFILING_DIR, f'{name}.prof'))
+    with open(os.path.join(PROFILING_DIR, f'{name}.json'), 'w') as f:
+        json.dump({
+            'view': view,
+            'method': request.method,
+            'path': request.get_full_path(),
+            'user': request.user.username if request.user.is_authenticated else None,
+            'status': response.status_code,
+            'ms': round(seconds * 1000, 2),
+            'db_ms': round(sum(query['ms'] for query in recorder.queries), 2),
+            'queries': recorder.queries,
+        }, f, indent=1)
+    prune_profiles()
+    return name
+
+
+def saved_profiles():
+    """Names of the saved profiles, the newest first."""
+    if not os.path.isdir(PROFILING_DIR):
+        return []
+    names = {os.path.splitext(file_name)[0] for file_name in os.listdir(PROFILING_DIR)}
+    return sorted((name for name in names if PROFILE_NAME.match(name)), reverse=True)
+
+
+def load_summary(name):
+    with open(os.path.join(PROFILING_DIR, f'{name}.json')) as f:
+        summary = json.load(f)
+    summary['name'] = name
+    summary['queries_amount'] = len(summary.pop('queries'))
+    return summary
+
+
+def prune_profiles():
+    for name in saved_profiles()[PROFILING_KEEP:]:
+        for extension in ('.prof', '.json'):
+            try:
+                os.remove(os.path.join(PROFILING_DIR, name + extension))
+            except FileNotFoundError:
+                pass
+
+
+class ProfilingMiddleware:
+    """
+    Runs a request under cProfile when a staff member asks for it or it falls
+    in the PROFILING_SAMPLE_RATE sample, and saves the stats and the SQL of the
+    request to PROFILING_DIR. Other requests only pay for a header and a flag lookup.
+    """
+
+    def __init__(self, get_response):
+        if not PROFILING_ENABLED:
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        sampled = PROFILING_SAMPLE_RATE > 0 and random.random() < PROFILING_SAMPLE_RATE
+        if not sampled and not is_requested(request):
+            return self.get_response(request)
+
+        profiler = cProfile.Profile()
+        recorder = SQLRecorder()
+        started = time.perf_counter()
+        with ExitStack() as stack:
+            for connection in connections.all():
+                stack.enter_context(connection.execute_wrapper(recorder))
+            profiler.enable()
+            try:
+                response = self.get_response(request)
+            finally:
+                profiler.disable()
+        seconds = time.perf_counter() - started
+
+        response['X-Profile-Name'] = save_profile(profiler, recorder, request, response, seconds)
+        return response
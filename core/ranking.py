@@ -0,0 +1,107 @@
+import threading
+import time
+
+import numpy as np
+
+from TamTut.settings import NEARBY_DISTANCE_SCALE_KM, NEARBY_SNAPSHOT_TTL
+
+EARTH_RADIUS_KM = 6371.0088
+# number of set bits of every byte value, for counting shared hobbies in packed bitmasks
+POPCOUNT = np.array([bin(byte).count('1') for byte in range(256)], dtype=np.uint8)
+
+
+class ProfileSnapshot:
+    """Coordinates and packed hobby bitmasks of all located profiles as parallel NumPy arrays."""
+
+    def __init__(self, ids, latitudes, longitudes, hobby_pairs):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        self.lat = np.radians(np.asarray(latitudes, dtype=np.float64))
+        self.lng = np.radians(np.asarray(longitudes, dtype=np.float64))
+        self.cos_lat = np.cos(self.lat)
+        self.row_of = {profile_id: row for row, profile_id in enumerate(ids)}
+
+        hobby_ids = sorted({hobby_id for _, hobby_id in hobby_pairs})
+        self.bit_of = {hobby_id: bit for bit, hobby_id in enumerate(hobby_ids)}
+        bits = np.zeros((len(self.ids), max(len(hobby_ids), 1)), dtype=bool)
+        for profile_id, hobby_id in hobby_pairs:
+            row = self.row_of.get(profile_id)
+            if row is not None:
+                bits[row, self.bit_of[hobby_id]] = True
+        self.masks = np.packbits(bits, axis=1)
+
+    @staticmethod
+    def load():
+        from core.models import Profile
+
+        located = Profile.objects.exclude(latitude=None).exclude(longitude=None).order_by('id')
+        rows = list(located.values_list('id', 'latitude', 'longitude'))
+        ids = [row[0] for row in rows]
+        hobby_pairs = Profile.hobby.through.objects.filter(profile__in=located)
+        hobby_pairs = list(hobby_pairs.values_list('profile_id', 'hobby_id'))
+        return ProfileSnapshot(ids, [row[1] for row in rows], [row[2] for row in rows], hobby_pairs)
+
+    def hobby_mask(self, hobby_ids):
+        bits = np.zeros(self.masks.shape[1] * 8, dtype=bool)
+        for hobby_id in hobby_ids:
+            if hobby_id in self.bit_of:
+                bits[self.bit_of[hobby_id]] = True
+        return np.packbits(bits)
+
+    def distances_km(self, latitude, longitude):
+        lat, lng = np.radians(latitude), np.radians(longitude)
+        haversine = (np.sin((self.lat - lat) / 2) ** 2 +
+                     np.cos(lat) * self.cos_lat * np.sin((self.lng - lng) / 2) ** 2)
+        return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.clip(haversine, 0, 1)))
+
+    def shared_hobbies(self, hobby_ids):
+        return POPCOUNT[self.masks & self.hobby_mask(hobby_ids)].sum(axis=1, dtype=np.int32)
+
+    def nearby(self, profile_id, latitude, longitude, hobby_ids, k):
+        """
+        Top `k` profiles by shared hobbies discounted by distance, as a list of
+        (profile id, distance in km, shared hobbies) with the best first.
+        """
+        shared = self.shared_hobbies(hobby_ids)
+        distances = self.distances_km(latitude, longitude)
+        scores = shared / (1 + distances / NEARBY_DISTANCE_SCALE_KM)
+        scores[shared == 0] = -1
+        if profile_id in self.row_of:
+            scores[self.row_of[profile_id]] = -1
+
+        candidates = np.flatnonzero(scores > 0)
+        if len(candidates) > k:
+            candidates = candidates[np.argpartition(-scores[candidates], k - 1)[:k]]
+        candidates = candidates[np.lexsort((self.ids[candidates], -scores[candidates]))]
+        return [(int(self.ids[row]), float(distances[row]), int(shared[row])) for row in candidates]
+
+
+_snapshot = None
+_snapshot_loaded = 0.0
+# held while a snapshot is being loaded, readers never wait for it once there is one
+_reload_lock = threading.Lock()
+
+
+def _is_fresh():
+    return _snapshot is not None and time.monotonic() - _snapshot_loaded <= NEARBY_SNAPSHOT_TTL
+
+
+def profile_snapshot():
+    """
+    Process-wide snapshot, reloaded from the database at most every NEARBY_SNAPSHOT_TTL seconds.
+    The request that finds it stale reloads it, the others keep using the stale one meanwhile.
+    """
+    global _snapshot, _snapshot_loaded
+    snapshot = _snapshot
+    if _is_fresh():
+        return snapshot
+    # only the very first load makes other requests wait
+    if not _reload_lock.acquire(blocking=snapshot is None):
+        return snapshot
+    try:
+        if _is_fresh():
+            return _snapshot
+        snapshot = ProfileSnapshot.load()
+        _snapshot, _snapshot_loaded = snapshot, time.monotonic()
+        return snapshot
+    finally:
+        _reload_lock.release()
@@ -0,0 +1,90 @@
+import math
+import threading
+import time
+
+from django.core.exceptions import MiddlewareNotUsed
+from django.db import connections
+
+from TamTut.settings import REPLICA_PIN_SECONDS
+
+PRIMARY_ALIAS = 'default'
+REPLICA_ALIAS = 'replica'
+# until this timestamp the reads of the client stay on the primary
+PIN_COOKIE = 'primary_until'
+SAFE_METHODS = ('GET', 'HEAD', 'OPTIONS')
+# apps whose reads must always see the latest writes
+PRIMARY_ONLY_APPS = {'sessions'}
+
+_state = threading.local()
+
+
+def replica_configured():
+    return REPLICA_ALIAS in connections.databases
+
+
+def reads_from_replica():
+    """Whether the current request still reads from the replica, see PrimaryReplicaRouter."""
+    return getattr(_state, 'use_replica', False) and replica_configured()
+
+
+class PrimaryReplicaRouter:
+    """
+    Writes go to the primary. Reads go to the replica only inside a request
+    that ReplicaRoutingMiddleware allowed to use it, and only until the request
+    writes something; code outside requests always reads from the primary.
+    """
+
+    def db_for_read(self, model, **hints):
+        if not getattr(_state, 'use_replica', False) or model._meta.app_label in PRIMARY_ONLY_APPS:
+            return PRIMARY_ALIAS
+        if not replica_configured() or connections[PRIMARY_ALIAS].in_atomic_block:
+            # a transaction must read its own writes
+            return PRIMARY_ALIAS
+        return REPLICA_ALIAS
+
+    def db_for_write(self, model, **hints):
+        if model._meta.app_label not in PRIMARY_ONLY_APPS:
+            _state.wrote = True
+            _state.use_replica = False
+        return PRIMARY_ALIAS
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # both aliases hold the same data
+        return True
+
+    def allow_migrate(self, db, app_label, model_name=None, **hints):
+        return db == PRIMARY_ALIAS
+
+
+def is_pinned(request):
+    try:
+        return float(request.COOKIES.get(PIN_COOKIE, 0)) > time.time()
+    except ValueError:
+        return False
+
+
+class ReplicaRoutingMiddleware:
+    """
+    Lets read-only requests read from the replica, except for clients that
+    wrote less than REPLICA_PIN_SECONDS ago, so users see their own posts, likes
+    and messages right away despite the replication lag.
+    """
+
+    def __init__(self, get_response):
+        if not replica_configured():
+            raise MiddlewareNotUsed
+        self.get_response = get_response
+
+    def __call__(self, request):
+        _state.use_replica = request.method in SAFE_METHODS and not is_pinned(request)
+        _state.wrote = False
+        try:
+            response = self.get_response(request)
+            wrote = _state.wrote
+        finally:
+            _state.use_replica = _state.wrote = False
+
+        if wrote:
+            response.set_cookie(PIN_COOKIE, str(time.time() + REPLICA_PIN_SECONDS),
+                                max_age=math.ceil(REPLICA_PIN_SECONDS), httponly=True, samesite='Lax')
+        return response
@@ -1,7 +1,29 @@
-from django.db.models.signals import post_save
+from django.db import transaction
+from django.db.models import F, Value
+from django.db.models.signals import post_save, post_delete, m2m_changed
 from django.contrib.auth.models import User
 from django.dispatch import receiver
-from .models import Profile
+from .models import Profile, Post, TimelineEntry, Message, GroupChat, Conversation
+from .cache import bump_version
+from .hobby_index import invalidate_hobby_index
+from .notifier import message_notifier, dialog_key, group_chat_key
+
+
+def bump_versions_on_commit(model, pks):
+    # a request reading the old rows until the commit must not cache them under the new versions
+    label, pks = model._meta.label_lower, list(pks)
+
+    def bump():
+        for pk in pks:
+            bump_version(label, pk)
+    transaction.on_commit(bump)
+
+
+def related_manager(sender, instance, reverse, model):
+    """The manager of `instance` over the many-to-many relation with the `sender` through model."""
+    owner = model if reverse else type(instance)
+    field = next(field for field in owner._meta.many_to_many if field.remote_field.through is sender)
+    return getattr(instance, field.remote_field.get_accessor_name() if reverse else field.name)
 
 
 @receiver(post_save, sender=User)
@@ -12,4 +34,213 @@ def create_profile(sender, instance, created, **kwargs):
 
 @receiver(post_save, sender=User)
 def save_profile(sender, instance, **kwargs):
-    instance.profile.save()
+    # a profile that was never loaded through this user can't have been changed through it;
+    # a loaded one is only written if its fields differ from the database
+    if User.profile.is_cached(instance):
+        instance.profile.save()
+
+
+@receiver(m2m_changed, sender=Post.liked_by.through)
+def update_likes_count(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_remove':
+        # `pk_set` holds everything passed to remove(), likes that don't exist must not be subtracted
+        likes = Post.liked_by.through.objects
+        if reverse:
+            removed = likes.filter(profile=instance, post__in=pk_set).values_list('post_id', flat=True)
+        else:
+            removed = likes.filter(post=instance, profile__in=pk_set).values_list('profile_id', flat=True)
+        instance._removed_likes = list(removed)
+        return
+    if action == 'pre_clear':
+        if reverse:
+            # `instance` is a Profile, so the affected posts have to be remembered before a clear
+            instance._cleared_liked_posts = list(instance.liked.values_list('pk', flat=True))
+        return
+
+    if action == 'post_add':
+        delta = 1
+    elif action == 'post_remove':
+        pk_set = instance.__dict__.pop('_removed_likes', [])
+        delta = -1
+    elif action == 'post_clear' and reverse:
+        pk_set = instance.__dict__.pop('_cleared_liked_posts', [])
+        delta = -1
+    elif action == 'post_clear':
+        # every like of the post is gone
+        Post.objects.filter(pk=instance.pk).update(**Post.likes_count_update(Value(0)))
+        return
+    else:
+        return
+    if not pk_set:
+        return
+
+    # every post in `pk_set` gained or lost one like, or the post `instance` one per profile in it
+    if reverse:
+        Post.objects.filter(pk__in=pk_set).update(**Post.likes_count_update(F('likes_count') + delta))
+    else:
+        Post.objects.filter(pk=instance.pk).update(**Post.likes_count_update(F('likes_count') + delta * len(pk_set)))
+
+
+@receiver(post_save, sender=Post)
+def fan_out_post(sender, instance, created, **kwargs):
+    if created and instance.author_id is not None:
+        TimelineEntry.fan_out(instance)
+
+
+def change_posts_count(author_id, delta):
+    if author_id is not None:
+        Profile.objects.filter(pk=author_id).update(posts_count=F('posts_count') + delta)
+        # the counters are written with an update, which sends no post_save to bump the profile
+        bump_versions_on_commit(Profile, [author_id])
+
+
+@receiver(post_save, sender=Post)
+def count_created_post(sender, instance, created, **kwargs):
+    if created:
+        change_posts_count(instance.author_id, 1)
+
+
+@receiver(post_delete, sender=Post)
+def count_deleted_post(sender, instance, **kwargs):
+    change_posts_count(instance.author_id, -1)
+
+
+@receiver(m2m_changed, sender=Profile.follows.through)
+def update_follows(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_remove':
+        # `pk_set` holds everything passed to remove(), follows that don't exist must not be subtracted
+        follows = Profile.follows.through.objects
+        if reverse:
+            removed = follows.filter(to_profile=instance, from_profile__in=pk_set)
+            instance._removed_follows = list(removed.values_list('from_profile_id', flat=True))
+        else:
+            removed = follows.filter(from_profile=instance, to_profile__in=pk_set)
+            instance._removed_follows = list(removed.values_list('to_profile_id', flat=True))
+        return
+    if action == 'pre_clear':
+        # remember who was affected, the relation is already gone in post_clear
+        related = instance.followed_by if reverse else instance.follows
+        instance._cleared_follows = list(related.values_list('pk', flat=True))
+        return
+
+    if action == 'post_remove':
+        pk_set = instance.__dict__.pop('_removed_follows', [])
+    elif action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_follows', [])
+    elif action != 'post_add':
+        return
+    if not pk_set:
+        return
+
+    if action == 'post_clear':
+        # a clear is rare and recounts, like repair_profile_counters
+        Profile.refresh_counters(Profile.objects.filter(pk__in={instance.pk, *pk_set}),
+                                 fields=('followers_count', 'following_count'))
+        action = 'post_remove'
+    else:
+        # `instance` follows or is followed by one more or one less profile per pk in `pk_set`
+        delta = 1 if action == 'post_add' else -1
+        own, theirs = ('followers_count', 'following_count') if reverse else ('following_count', 'followers_count')
+        Profile.objects.filter(pk=instance.pk).update(**{own: F(own) + delta * len(pk_set)})
+        Profile.objects.filter(pk__in=pk_set).update(**{theirs: F(theirs) + delta})
+
+    if reverse:
+        # `instance` gained or lost the followers in `pk_set`
+        pairs = [(follower_id, [instance.pk]) for follower_id in pk_set]
+    else:
+        pairs = [(instance.pk, list(pk_set))]
+
+    for follower_id, followed_ids in pairs:
+        if action == 'post_add':
+            TimelineEntry.backfill(follower_id, followed_ids)
+        else:
+            TimelineEntry.prune(follower_id, followed_ids)
+
+
+@receiver(post_save, sender=Message)
+def update_conversations(sender, instance, created, **kwargs):
+    if created:
+        Conversation.register_message(instance)
+
+
+@receiver(post_save, sender=Message)
+def notify_new_message(sender, instance, created, **kwargs):
+    if not created:
+        return
+    if instance.group_chat_in_id is not None:
+        key = group_chat_key(instance.group_chat_in_id)
+    else:
+        key = dialog_key(instance.sender_id, instance.receiver_id)
+    # waiters query the database right away, so they must not be woken before the message is visible
+    transaction.on_commit(lambda: message_notifier.notify(key))
+
+
+@receiver(m2m_changed, sender=GroupChat.chat_users.through)
+def update_group_chat_conversations(sender, instance, action, reverse, pk_set, **kwargs):
+    if action == 'pre_clear':
+        related = instance.inside_group_chats if reverse else instance.chat_users
+        instance._cleared_chat_users = list(related.values_list('pk', flat=True))
+        return
+    if action == 'post_clear':
+        pk_set = instance.__dict__.pop('_cleared_chat_users', [])
+        action = 'post_remove'
+    if action not in ('post_add', 'post_remove') or not pk_set:
+        return
+
+    if action == 'post_remove':
+        if reverse:
+            Conversation.leave_group_chat(pk_set, [instance.pk])
+        else:
+            Conversation.leave_group_chat([instance.pk], pk_set)
+    elif reverse:
+        for group_chat in GroupChat.objects.filter(pk__in=pk_set):
+            Conversation.join_group_chat(group_chat, [instance.pk])
+    else:
+        Conversation.join_group_chat(instance, pk_set)
+
+
+@receiver(m2m_changed, sender=Profile.hobby.through)
+def update_hobby_index(sender, action, **kwargs):
+    if action in ('post_add', 'post_remove', 'post_clear'):
+        transaction.on_commit(invalidate_hobby_index)
+
+
+@receiver(post_save, sender=User)
+@receiver(post_save, sender=Post)
+@receiver(post_save, sender=Profile)
+@receiver(post_save, sender=Message)
+@receiver(post_save, sender=GroupChat)
+@receiver(post_delete, sender=User)
+@receiver(post_delete, sender=Post)
+@receiver(post_delete, sender=Profile)
+@receiver(post_delete, sender=Message)
+@receiver(post_delete, sender=GroupChat)
+def bump_cache_version(sender, instance, **kwargs):
+    if kwargs.get('update_fields') == frozenset({'last_login'}):
+        # logging in changes nothing that is rendered
+        return
+    bump_versions_on_commit(sender, [instance.pk])
+    if sender is Message and instance.group_chat_in_id is not None:
+        bump_versions_on_commit(GroupChat, [instance.group_chat_in_id])
+
+
+@receiver(m2m_changed, sender=Post.liked_by.through)
+@receiver(m2m_changed, sender=Profile.follows.through)
+@receiver(m2m_changed, sender=Profile.hobby.through)
+@receiver(m2m_changed, sender=GroupChat.chat_users.through)
+def bump_m2m_cache_versions(sender, instance, action, reverse, model, pk_set, **kwargs):
+    # the other side is only versioned for the models cached per object
+    versioned = model in (Post, Profile, GroupChat)
+    cleared_attr = f'_cleared_{sender._meta.model_name}'
+    if action == 'pre_clear' and versioned:
+        # post_clear has no pk_set, the related objects are only known before they are gone
+        related = related_manager(sender, instance, reverse, model)
+        setattr(instance, cleared_attr, list(related.values_list('pk', flat=True)))
+        return
+    if action == 'post_clear':
+        pk_set = instance.__dict__.pop(cleared_attr, ())
+    if action not in ('post_add', 'post_remove', 'post_clear'):
+        return
+    bump_versions_on_commit(type(instance), [instance.pk])
+    if versioned:
+        bump_versions_on_commit(model, pk_set)
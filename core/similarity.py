@@ -0,0 +1,241 @@
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from itertools import chain
+
+import numpy as np
+from django.db import connection, connections, transaction
+from django.db.models import Count, Min, OuterRef, Subquery, IntegerField
+
+from TamTut.settings import SIMILAR_PROFILES_COUNT, SIMILAR_REFRESH_HOLDERS_LIMIT, SIMILARITY_WORKERS
+from core.models import Profile, SimilarProfile
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+# keeps the best k entries of every list of the given profiles, ties broken by id like top_k
+TRIM_SQL = '''
+    DELETE FROM {table} WHERE id IN (
+        SELECT id FROM (
+            SELECT id, ROW_NUMBER() OVER (PARTITION BY profile_id ORDER BY score DESC, similar_id) AS position
+            FROM {table} WHERE profile_id IN ({profiles})
+        ) ranked WHERE position > %s
+    )
+'''
+
+M1, M2, M4 = np.uint64(0x5555555555555555), np.uint64(0x3333333333333333), np.uint64(0x0f0f0f0f0f0f0f0f)
+H01 = np.uint64(0x0101010101010101)
+
+
+def popcount(words):
+    """Set bits of every uint64 of `words` (SWAR, numpy has no popcount); `words` is overwritten."""
+    words -= (words >> np.uint64(1)) & M1
+    words = (words & M2) + ((words >> np.uint64(2)) & M2)
+    words += words >> np.uint64(4)
+    words &= M4
+    words *= H01
+    words >>= np.uint64(56)
+    return words
+
+
+def intersections(chunk, sets):
+    """Sizes of the intersections of every bitset of `chunk` with every bitset of `sets`, word by word."""
+    total = popcount(chunk[:, None, 0] & sets[None, :, 0])
+    for word in range(1, sets.shape[1]):
+        total += popcount(chunk[:, None, word] & sets[None, :, word])
+    return total.astype(np.int64)
+
+
+def hobby_bitsets(ids, hobby_pairs):
+    """
+    The hobby set of every profile of `ids` as a bitset of uint64 words, one bit per hobby.
+    Profiles with the same hobbies share a bitset: the set of `ids[i]` is `sets[groups[i]]`.
+    """
+    ids = np.asarray(ids, dtype=np.int64)
+    hobby_pairs = np.asarray(hobby_pairs, dtype=np.int64).reshape(-1, 2)
+    hobby_ids = np.unique(hobby_pairs[:, 1])
+    bits = np.zeros((len(ids), max(-(-len(hobby_ids) // 64), 1) * 64), dtype=bool)
+    bits[np.searchsorted(ids, hobby_pairs[:, 0]), np.searchsorted(hobby_ids, hobby_pairs[:, 1])] = True
+    sets, groups = np.unique(np.packbits(bits, axis=1).view(np.uint64), axis=0, return_inverse=True)
+    return sets, groups.reshape(-1)
+
+
+def load_hobby_bitsets():
+    ids = np.fromiter(Profile.objects.order_by('id').values_list('id', flat=True).iterator(), dtype=np.int64)
+    pairs = Profile.hobby.through.objects.values_list('profile_id', 'hobby_id').iterator()
+    hobby_pairs = np.fromiter(chain.from_iterable(pairs), dtype=np.int64)
+    return (ids, *hobby_bitsets(ids, hobby_pairs))
+
+
+def top_k_jaccard(ids, sets, groups, k, chunk_size=64):
+    """
+    Yield (profile id, [(similar profile id, jaccard), ...]) for every profile of the sorted `ids`.
+
+    Similarity only depends on the hobby set, so a chunk of distinct sets is
+    scored against all distinct sets, and every profile gets the members of
+    the best sets, ties broken by id. The work grows with the number of
+    distinct hobby sets rather than with the number of profiles.
+    """
+    sizes = popcount(sets.copy()).sum(axis=1, dtype=np.int64)
+    # the profiles of set `g` are ids[members[starts[g]:starts[g + 1]]], in id order
+    members = np.argsort(groups, kind='stable')
+    starts = np.zeros(len(sets) + 1, dtype=np.int64)
+    np.cumsum(np.bincount(groups, minlength=len(sets)), out=starts[1:])
+    first_ids = ids[members[starts[:-1]]]
+
+    for first in range(0, len(sets), chunk_size):
+        shared = intersections(sets[first:first + chunk_size], sets)
+        unions = sizes[first:first + chunk_size, None] + sizes[None, :] - shared
+        scores = shared / np.maximum(unions, 1)
+        # every set has a member, so the best k + 1 sets fill a list even without the profile itself
+        if len(sets) > k + 1:
+            cutoffs = np.partition(scores, len(sets) - k - 1, axis=1)[:, len(sets) - k - 1]
+        else:
+            cutoffs = np.zeros(len(scores))
+
+        for offset, row in enumerate(scores):
+            cutoff = cutoffs[offset]
+            if cutoff > 0:
+                tied = np.flatnonzero(row == cutoff)
+                if len(tied) > k + 1:
+                    # of equally scored sets only the ones holding the smallest ids can make it
+                    tied = tied[np.argpartition(first_ids[tied], k)[:k + 1]]
+                candidates = np.concatenate([np.flatnonzero(row > cutoff), tied])
+            else:
+                candidates = np.flatnonzero(row > 0)
+
+            # and of every set only its k + 1 smallest ids
+            taken = np.minimum(starts[candidates + 1] - starts[candidates], k + 1)
+            rows = members[np.repeat(starts[candidates] - np.cumsum(taken) + taken, taken) + np.arange(taken.sum())]
+            row_scores = np.repeat(row[candidates], taken)
+            order = np.lexsort((ids[rows], -row_scores))[:k + 1]
+            neighbours = list(zip(ids[rows[order]].tolist(), row_scores[order].tolist()))
+
+            group = first + offset
+            for profile_id in ids[members[starts[group]:starts[group + 1]]].tolist():
+                yield profile_id, [entry for entry in neighbours if entry[0] != profile_id][:k]
+
+
+def rebuild_similar_profiles(k=SIMILAR_PROFILES_COUNT, batch_size=1000):
+    ids, sets, groups = load_hobby_bitsets()
+    with transaction.atomic():
+        SimilarProfile.objects.all().delete()
+        rows = []
+        for profile_id, similar in top_k_jaccard(ids, sets, groups, k):
+            rows.extend(SimilarProfile(profile_id=profile_id, similar_id=similar_id, score=score)
+                        for similar_id, score in similar)
+            if len(rows) >= batch_size:
+                SimilarProfile.objects.bulk_create(rows)
+                rows = []
+        SimilarProfile.objects.bulk_create(rows)
+    return len(ids)
+
+
+def jaccard_with(profile):
+    """Jaccard similarity of `profile` to every profile sharing a hobby with it, computed in SQL."""
+    hobbies = list(profile.hobby.values_list('id', flat=True))
+    if not hobbies:
+        return {}
+    hobby_amounts = Profile.hobby.through.objects.filter(profile=OuterRef('pk')).order_by().values('profile')
+    hobby_amounts = hobby_amounts.annotate(amount=Count('pk')).values('amount')
+    candidates = Profile.objects.filter(hobby__in=hobbies).exclude(id=profile.id).annotate(
+        shared=Count('hobby'), hobbies_amount=Subquery(hobby_amounts, output_field=IntegerField()),
+    )
+    return {
+        profile_id: shared / (len(hobbies) + hobbies_amount - shared)
+        for profile_id, shared, hobbies_amount in candidates.values_list('id', 'shared', 'hobbies_amount')
+    }
+
+
+def top_k(scores, k):
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))[:k]
+
+
+def trim_similar_profiles(profile_ids, k):
+    if profile_ids:
+        sql = TRIM_SQL.format(table=SimilarProfile._meta.db_table, profiles=', '.join(['%s'] * len(profile_ids)))
+        with connection.cursor() as cursor:
+            cursor.execute(sql, [*profile_ids, k])
+
+
+def replace_similar_profiles(profile, k):
+    scores = jaccard_with(profile)
+    SimilarProfile.objects.filter(profile=profile).delete()
+    SimilarProfile.objects.bulk_create([SimilarProfile(profile=profile, similar_id=similar_id, score=score)
+                                        for similar_id, score in top_k(scores, k)])
+    return scores
+
+
+def refresh_neighbour_lists(profile_id, scores, k=SIMILAR_PROFILES_COUNT, holders_limit=SIMILAR_REFRESH_HOLDERS_LIMIT,
+                            batch_size=1000):
+    """
+    Put `profile_id` with its new `scores` into the lists of other profiles.
+
+    Jaccard similarity is symmetric, so `scores` are also its scores in their
+    lists: it is dropped from the lists holding it, added to the lists it now
+    makes, and every grown list is trimmed back to k. A list it left or went
+    down in may now miss a neighbour cut off before, the first `holders_limit`
+    of those are recomputed and the rest wait for rebuild_similar_profiles.
+    """
+    with transaction.atomic():
+        held = SimilarProfile.objects.filter(similar_id=profile_id)
+        held_scores = dict(held.values_list('profile_id', 'score'))
+        held.delete()
+
+        candidates = sorted(scores)
+        for first in range(0, len(candidates), batch_size):
+            batch = candidates[first:first + batch_size]
+            lists = SimilarProfile.objects.filter(profile_id__in=batch).order_by().values('profile_id')
+            lists = lists.annotate(size=Count('id'), weakest=Min('score')).values_list('profile_id', 'size', 'weakest')
+            current = {profile: (size, weakest) for profile, size, weakest in lists}
+            added = [profile for profile in batch
+                     if profile not in current or current[profile][0] < k or scores[profile] >= current[profile][1]]
+            SimilarProfile.objects.bulk_create([SimilarProfile(profile_id=profile, similar_id=profile_id,
+                                                               score=scores[profile]) for profile in added])
+            trim_similar_profiles([profile for profile in added if profile in current], k)
+
+        stale = sorted(profile for profile, score in held_scores.items() if scores.get(profile, 0) < score)
+        for holder in Profile.objects.filter(id__in=stale[:holders_limit]):
+            replace_similar_profiles(holder, k)
+
+
+def _refresh_neighbour_lists_safely(profile_id, scores, k):
+    try:
+        refresh_neighbour_lists(profile_id, scores, k)
+    except Exception:
+        logger.exception('Failed to refresh the lists of similar profiles around %s', profile_id)
+
+
+def _refresh_neighbour_lists_in_worker(profile_id, scores, k):
+    try:
+        _refresh_neighbour_lists_safely(profile_id, scores, k)
+    finally:
+        # the connections of a pool thread are its own and would stay open otherwise
+        connections.close_all()
+
+
+def schedule_neighbour_refresh(profile_id, scores, k=SIMILAR_PROFILES_COUNT):
+    """Run refresh_neighbour_lists on the worker pool, or inline without workers."""
+    if SIMILARITY_WORKERS <= 0:
+        _refresh_neighbour_lists_safely(profile_id, scores, k)
+        return
+
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(max_workers=SIMILARITY_WORKERS, thread_name_prefix='similarity')
+    _executor.submit(_refresh_neighbour_lists_in_worker, profile_id, scores, k)
+
+
+def refresh_similar_profiles(profile, k=SIMILAR_PROFILES_COUNT):
+    """
+    Incremental update after the hobbies of `profile` changed: its own list is
+    recomputed right away, the lists of other profiles after the commit, off
+    the request thread, see refresh_neighbour_lists.
+    """
+    with transaction.atomic():
+        scores = replace_similar_profiles(profile, k)
+    profile_id = profile.id
+    transaction.on_commit(lambda: schedule_neighbour_refresh(profile_id, scores, k))
@@ -0,0 +1,56 @@
+import hashlib
+import os
+import posixpath
+import re
+
+from django.core.files.storage import FileSystemStorage
+
+from core.images import VARIANTS_DIR
+
+SHA256_HEX = re.compile('[0-9a-f]{64}')
+
+
+def is_content_hash_name(name):
+    dir_name, file_name = posixpath.split(name)
+    digest = os.path.splitext(file_name)[0]
+    return bool(SHA256_HEX.fullmatch(digest)) and posixpath.basename(dir_name) == digest[:2]
+
+
+class ContentHashStorage(FileSystemStorage):
+    """
+    Stores uploads under the SHA-256 of their content, `profile_pics/ab/ab12...ef.jpg`.
+
+    Identical uploads end up as one file, so their variants are generated once
+    and reused, and a stored name never changes content, which lets nginx serve
+    it with far-future cache headers. Variants are already named after their
+    hashed original and are stored as is.
+    """
+
+    def _save(self, name, content):
+        if name.startswith(VARIANTS_DIR + '/'):
+            return super()._save(name, content)
+
+        sha256 = hashlib.sha256()
+        for chunk in content.chunks():
+            sha256.update(chunk)
+        digest = sha256.hexdigest()
+
+        dir_name, file_name = posixpath.split(name)
+        extension = os.path.splitext(file_name)[1].lower()
+        name = posixpath.join(dir_name, digest[:2], digest + extension)
+        if self.exists(name):
+            return name
+        try:
+            return super()._save(name, content)
+        except FileExistsError:
+            return name
+
+    def get_available_name(self, name, max_length=None):
+        # the final name comes from the content in _save, reusing an existing file is intended
+        if name.startswith(VARIANTS_DIR + '/'):
+            return super().get_available_name(name, max_length)
+        if is_content_hash_name(name):
+            # FileSystemStorage._save asks for another name when an identical upload
+            # was saved concurrently, there is none: the existing file is the one
+            raise FileExistsError(name)
+        return name
@@ -0,0 +1,86 @@
+from itertools import chain
+
+import numpy as np
+from django.db import transaction
+
+from TamTut.settings import SUGGESTED_PROFILES_COUNT, SUGGESTION_HOBBY_WEIGHT
+from core.models import Profile, SuggestedProfile
+from core.ranking import POPCOUNT
+
+
+def _pairs(queryset, *fields):
+    """Two integer columns of a queryset as an (n, 2) array, without building a tuple per row."""
+    flat = np.fromiter(chain.from_iterable(queryset.values_list(*fields).iterator()), dtype=np.int64)
+    return flat.reshape(-1, 2)
+
+
+class FollowGraph:
+    """
+    The follow graph in CSR form over row numbers of the sorted profile ids: the
+    profiles followed by row `r` are `targets[indptr[r]:indptr[r + 1]]`.
+    Hobbies of every row are kept as packed bitmasks.
+    """
+
+    def __init__(self, ids, edges, hobby_pairs):
+        self.ids = np.asarray(ids, dtype=np.int64)
+        sources = np.searchsorted(self.ids, edges[:, 0])
+        order = np.argsort(sources, kind='stable')
+        self.targets = np.searchsorted(self.ids, edges[order, 1]).astype(np.int32)
+        self.indptr = np.zeros(len(self.ids) + 1, dtype=np.int64)
+        np.cumsum(np.bincount(sources, minlength=len(self.ids)), out=self.indptr[1:])
+
+        hobby_ids = np.unique(hobby_pairs[:, 1])
+        bits = np.zeros((len(self.ids), max(len(hobby_ids), 1)), dtype=bool)
+        bits[np.searchsorted(self.ids, hobby_pairs[:, 0]), np.searchsorted(hobby_ids, hobby_pairs[:, 1])] = True
+        self.masks = np.packbits(bits, axis=1)
+
+    @staticmethod
+    def load():
+        ids = np.fromiter(Profile.objects.order_by('id').values_list('id', flat=True).iterator(), dtype=np.int64)
+        edges = _pairs(Profile.follows.through.objects.all(), 'from_profile_id', 'to_profile_id')
+        hobby_pairs = _pairs(Profile.hobby.through.objects.all(), 'profile_id', 'hobby_id')
+        return FollowGraph(ids, edges, hobby_pairs)
+
+    def followed(self, row):
+        return self.targets[self.indptr[row]:self.indptr[row + 1]]
+
+    def followed_by_all(self, rows):
+        """Concatenated followed lists of `rows`, gathered without a Python loop."""
+        starts, lengths = self.indptr[rows], self.indptr[rows + 1] - self.indptr[rows]
+        offsets = np.repeat(starts - np.cumsum(lengths) + lengths, lengths)
+        return self.targets[offsets + np.arange(offsets.size)]
+
+    def suggestions(self, row, k, hobby_weight=SUGGESTION_HOBBY_WEIGHT):
+        """
+        Top `k` friends of friends of `row` not followed by it yet, as a list of
+        (profile id, mutual follows, shared hobbies, score) with the best first.
+        """
+        followed = self.followed(row)
+        if not len(followed):
+            return []
+        # every path row -> followed -> candidate is one mutual follow
+        candidates, mutual = np.unique(self.followed_by_all(followed), return_counts=True)
+        keep = ~np.isin(candidates, followed, assume_unique=True) & (candidates != row)
+        candidates, mutual = candidates[keep], mutual[keep]
+
+        shared = POPCOUNT[self.masks[candidates] & self.masks[row]].sum(axis=1, dtype=np.int32)
+        scores = mutual + hobby_weight * shared
+        # rows follow the sorted ids, so equal scores go to the smallest ids, also at the k-th place
+        order = np.lexsort((candidates, -scores))[:k]
+        return [(int(self.ids[candidates[i]]), int(mutual[i]), int(shared[i]), float(scores[i])) for i in order]
+
+
+def rebuild_suggested_profiles(k=SUGGESTED_PROFILES_COUNT, batch_size=1000):
+    graph = FollowGraph.load()
+    with transaction.atomic():
+        SuggestedProfile.objects.all().delete()
+        rows = []
+        for row, profile_id in enumerate(graph.ids.tolist()):
+            rows.extend(SuggestedProfile(profile_id=profile_id, suggested_id=suggested_id, mutual_follows=mutual,
+                                         shared_hobbies=shared, score=score)
+                        for suggested_id, mutual, shared, score in graph.suggestions(row, k))
+            if len(rows) >= batch_size:
+                SuggestedProfile.objects.bulk_create(rows)
+                rows = []
+        SuggestedProfile.objects.bulk_create(rows)
+    return len(graph.ids)
@@ -0,0 +1,42 @@
+from django import template
+
+from TamTut.settings import FRAGMENT_CACHE_TIMEOUT
+from core.cache import cache, versioned_key
+from core.routers import reads_from_replica
+
+register = template.Library()
+
+
+class VersionedCacheNode(template.Node):
+    def __init__(self, nodelist, name, vary_on):
+        self.nodelist = nodelist
+        self.name = name
+        self.vary_on = vary_on
+
+    def render(self, context):
+        objects = [obj for obj in (var.resolve(context) for var in self.vary_on) if obj is not None]
+        key = versioned_key(f'fragment:{self.name}', *objects)
+        if reads_from_replica():
+            # a lagging replica may still return rows older than the versions in the key, so
+            # a fragment rendered from it is not cached; one rendered from the primary is used
+            cached = cache.get(key)
+            return cached if cached is not None else self.nodelist.render(context)
+        return cache.get_or_set(key, lambda: self.nodelist.render(context), FRAGMENT_CACHE_TIMEOUT)
+
+
+@register.tag
+def versioned_cache(parser, token):
+    """
+    {% versioned_cache 'post_card' post post.author %}...{% endversioned_cache %}
+
+    Caches the rendered block under the versions of the given model instances,
+    so it is rendered again only after one of them changes. Keep anything that
+    depends on the viewer outside of the block.
+    """
+    bits = token.split_contents()
+    if len(bits) < 3:
+        raise template.TemplateSyntaxError(f"'{bits[0]}' takes a fragment name and at least one object")
+    nodelist = parser.parse(('endversioned_cache',))
+    parser.delete_first_token()
+    name = bits[1].strip('\'"')
+    return VersionedCacheNode(nodelist, name, [parser.compile_filter(bit) for bit in bits[2:]])
@@ -0,0 +1,11 @@
+from django import template
+
+from core.images import variant_url
+
+register = template.Library()
+
+
+@register.filter
+def thumbnail(image, size):
+    """{{ profile.image|thumbnail:40 }} is the URL of the variant of the image fitting 40x40 px."""
+    return variant_url(image, int(size))
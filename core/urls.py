@@ -17,11 +17,21 @@ urlpatterns = [
 
     path('chat/', views.chat_list, name='chat_list'),
     path('chat/<str:chat_username>/', views.chat_by_user, name='chat_by_user'),
+    path('chat/<str:chat_username>/history/', views.chat_by_user_history, name='chat_by_user_history'),
+    path('chat/<str:chat_username>/updates/', views.chat_by_user_updates, name='chat_by_user_updates'),
     path('chat/group/create/', views.group_chat_create, name='group_chat_create'),
     path('chat/group/<int:group_chat_id>/', views.group_chat, name='group_chat'),
+    path('chat/group/<int:group_chat_id>/history/', views.group_chat_history, name='group_chat_history'),
+    path('chat/group/<int:group_chat_id>/updates/', views.group_chat_updates, name='group_chat_updates'),
 
     path('map/', views.map_view, name='map_page'),
+    path('map/markers/', views.map_markers, name='map_markers'),
 
     path('likepost/<int:pk>/', views.like_post, name='like_post'),
     path('dislikepost/<int:pk>/', views.dislike_post, name='dislike_post'),
+
+    path('cache/stats/', views.cache_stats, name='cache_stats'),
+    path('metrics/', views.metrics, name='metrics'),
+    path('profiles/', views.profiles_list, name='profiles_list'),
+    path('profiles/<str:name>.<str:kind>', views.profile_download, name='profile_download'),
 ]
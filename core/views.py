@@ -1,24 +1,41 @@
-import datetime
+import hmac
+import os
+import threading
+import time
 
+from django.contrib.admin.views.decorators import staff_member_required
 from django.contrib.auth import authenticate, login
 from django.contrib.auth.decorators import login_required
-from django.core.paginator import Paginator
-from django.db.models import Q
-from django.http import HttpResponseRedirect
+from django.http import HttpResponseRedirect, JsonResponse, HttpResponse, HttpResponseForbidden, FileResponse, \
+    Http404
+from django.db import connections
+from django.db.models import Q, Exists, OuterRef
 from django.shortcuts import render, redirect, reverse, get_object_or_404
 from django.views.generic import ListView
 
-from TamTut.settings import POSTS_ON_PROFILE_PAGE, POSTS_ON_HOME_PAGE, DAYS_HOT_POSTS, FOLLOWERS_ON_FOLLOWS_PAGE
-from core.enums import FeedSorting
+from TamTut.settings import POSTS_ON_PROFILE_PAGE, POSTS_ON_HOME_PAGE, FOLLOWERS_ON_FOLLOWS_PAGE, \
+    CONVERSATIONS_ON_CHAT_PAGE, MESSAGES_ON_CHAT_PAGE, LONG_POLL_TIMEOUT, LONG_POLL_INTERVAL, LONG_POLL_MAX_WAITERS, \
+    MAP_MARKERS_LIMIT, PROFILES_ON_MAP_PAGE, NEARBY_PROFILES_ON_MAP, HOBBY_INDEX_ENABLED, METRICS_TOKEN, PROFILING_DIR
+from core.cache import cache
+from core.enums import FeedSorting, MapRanking
 from core.forms import *
-from core.models import Profile, Message, Post, Hobby, GroupChat
+from core.models import Profile, Message, Post, Hobby, GroupChat, TimelineEntry, Conversation, SimilarProfile, \
+    SuggestedProfile
+from core.notifier import message_notifier, dialog_key, group_chat_key
+from core.pagination import cursor_paginate, CursorPaginationMixin, CursorPaginator
+from core.hobby_index import hobby_index
+from core.db_pool.pool import render_pool_metrics
+from core.metrics import registry as metrics_registry, worker_totals
+from core.profiling import saved_profiles, load_summary, PROFILE_NAME
+from core.ranking import profile_snapshot
+from core.similarity import refresh_similar_profiles
 
+# every held long poll takes a worker thread, the ones past this are not held
+long_poll_slots = threading.BoundedSemaphore(LONG_POLL_MAX_WAITERS)
 
-def paginate(request, objects, num_of_elements):
-    objects = Paginator(objects, num_of_elements)
-    page = request.GET.get('page')
-    objects = objects.get_page(page)
-    return objects
+
+def paginate(request, objects, ordering, num_of_elements):
+    return cursor_paginate(request, objects, ordering, num_of_elements)
 
 
 def register(request):
@@ -60,50 +77,45 @@ def home(request, *args, **kwargs):
     all_posts = Post.objects.all()
     if feed_sorting is None:
         # means we return follower feed
-        following_profiles = request.user.profile.follows.all()
-        feed = get_followers_feed(request, following_profiles)
+        feed = TimelineEntry.feed(request.user.profile)
+        ordering = ('-feed_date', '-id')
     elif feed_sorting == FeedSorting.NEW:
-        feed = all_posts.order_by('-date_posted')
+        feed = all_posts
+        ordering = ('-date_posted', '-id')
     elif feed_sorting == FeedSorting.HOT:
-        date_from = datetime.datetime.now() - datetime.timedelta(days=DAYS_HOT_POSTS)
-        hot_feed = all_posts.filter(date_posted__gte=date_from)
-        feed = sorted(hot_feed, key=lambda x: x.likes_amount, reverse=True)
+        feed = all_posts
+        ordering = ('-hot_score', '-id')
     else:
-        feed = sorted(all_posts, key=lambda x: x.likes_amount, reverse=True)
+        feed = all_posts
+        ordering = ('-likes_count', '-date_posted', '-id')
 
-    feed = paginate(request, feed, POSTS_ON_HOME_PAGE)
+    feed = Post.for_viewer(feed, request.user.profile)
+    feed = paginate(request, feed, ordering, POSTS_ON_HOME_PAGE)
     context = {
         'feed': feed,
         'is_global_feed': is_global_feed,
+        'suggested_profiles': SuggestedProfile.for_profile(request.user.profile),
     }
     return render(request, 'core/home.html', context)
 
 
-def get_followers_feed(request, following_profiles):
-    followers_feed = Post.objects.filter(author__in=following_profiles)
-    if followers_feed.exists():
-        followers_feed = followers_feed.order_by('-date_posted')
-        followers_feed = paginate(request, followers_feed, POSTS_ON_HOME_PAGE)
-    return followers_feed
-
-
-class ProfileFollowersView(ListView):
+class ProfileFollowersView(CursorPaginationMixin, ListView):
     template_name = 'core/profile_followers_page.html'
     paginate_by = FOLLOWERS_ON_FOLLOWS_PAGE
 
     def get_queryset(self):
         target_profile = get_object_or_404(Profile, id=self.kwargs['pk'])
-        target_profile_followers = target_profile.followed_by.all()
+        target_profile_followers = target_profile.followed_by.select_related('user')
         return target_profile_followers
 
 
-class ProfileFollowingView(ListView):
+class ProfileFollowingView(CursorPaginationMixin, ListView):
     template_name = 'core/profile_following_page.html'
     paginate_by = FOLLOWERS_ON_FOLLOWS_PAGE
 
     def get_queryset(self):
         target_profile = get_object_or_404(Profile, id=self.kwargs['pk'])
-        target_profile_follows = target_profile.follows.all()
+        target_profile_follows = target_profile.follows.select_related('user')
         return target_profile_follows
 
 
@@ -115,17 +127,22 @@ def profile(request, pk):
         create_post_form = CreatePostForm()
 
         hobbies = target_profile.hobby.all()
-        followed_by = target_profile.followed_by.all()
+        is_following = request.user.is_authenticated and request.user.profile.is_following(target_profile)
 
         posts = target_profile.posts.all()
-        posts = paginate(request, posts, POSTS_ON_PROFILE_PAGE)
+        if request.user.is_authenticated:
+            posts = Post.for_viewer(posts, request.user.profile)
+        posts = paginate(request, posts, ('-date_posted', '-id'), POSTS_ON_PROFILE_PAGE)
         context = {
             'hobbies': hobbies,
             'prof': target_profile,
             'create_post_form': create_post_form,
             'posts': posts,
-            'followed_by': followed_by
+            'is_following': is_following,
+            'similar_profiles': SimilarProfile.most_similar(target_profile),
         }
+        if request.user.is_authenticated and request.user.profile == target_profile:
+            context['suggested_profiles'] = SuggestedProfile.for_profile(target_profile)
         return render(request, 'core/profile.html', context)
     else:
         create_post(request, target_profile)
@@ -146,7 +163,7 @@ def follow_target_profile(request, pk):
     target_user = get_object_or_404(User, id=pk)
     target_profile = Profile.objects.get(user=target_user)
     cur_profile = request.user.profile
-    if target_profile in cur_profile.follows.all():
+    if cur_profile.is_following(target_profile):
         cur_profile.follows.remove(target_profile)
     else:
         cur_profile.follows.add(target_profile)
@@ -197,14 +214,19 @@ def edit_profile(request):
 
 
 def save_cur_user_info(target_user, parameters):
-    for field, value in parameters.items():
-        setattr(target_user, field, value)
-    target_user.save()
+    changed_fields = [field for field, value in parameters.items() if getattr(target_user, field) != value]
+    for field in changed_fields:
+        setattr(target_user, field, parameters[field])
+    if changed_fields:
+        target_user.save(update_fields=changed_fields)
 
 
 def save_cur_prof_info(target_profile, hobby, image, coors):
     hobbies = Hobby.objects.filter(name__in=hobby)
+    old_hobbies = set(target_profile.hobby.values_list('id', flat=True))
     target_profile.hobby.set(hobbies)
+    if set(target_profile.hobby.values_list('id', flat=True)) != old_hobbies:
+        refresh_similar_profiles(target_profile)
 
     if image:
         target_profile.image = image
@@ -224,66 +246,166 @@ def map_view(request, *args, **kwargs):
     hobbies_form = HobbyList()
     all_profiles = Profile.objects.all()
     if request.method == 'GET':
-        cur_user_hobbies = request.user.profile.hobby.all()
-        matched_profiles = all_profiles.filter(hobby__in=cur_user_hobbies).distinct().exclude(
-            user=request.user)
+        cur_profile = request.user.profile
+        cur_user_hobbies = cur_profile.hobby.all()
+        wants_nearby = request.GET.get('ranking') == MapRanking.NEARBY.value
+        # the ranking needs the user's coordinates, without them all matches are shown with a note
+        is_nearby_ranking = wants_nearby and cur_profile.latitude is not None and cur_profile.longitude is not None
+        if is_nearby_ranking:
+            matched_profiles = nearby_profiles(cur_profile, cur_user_hobbies)
+        else:
+            matched_profiles = all_profiles.filter(hobby__in=cur_user_hobbies).distinct().exclude(
+                user=request.user).select_related('user')
+            matched_profiles = paginate(request, matched_profiles, ('id',), PROFILES_ON_MAP_PAGE)
 
         context = {
             'matched_profiles': matched_profiles,
             'hobbies_form': hobbies_form,
+            'is_nearby_ranking': is_nearby_ranking,
+            'nearby_needs_location': wants_nearby and not is_nearby_ranking,
+            'similar_profiles': SimilarProfile.most_similar(cur_profile),
         }
         return render(request, 'core/map.html', context)
     else:
         hobbies_form = HobbyList(request.POST or None)
         if hobbies_form.is_valid():
             hobbies = hobbies_form.cleaned_data['hobby']
-            matched_profiles = request.user.profile.filter_by_hobbies(hobbies).exclude(user=request.user)
-            any_match_profiles = Profile.objects.filter(hobby__in=hobbies).distinct()
+            hobby_ids = [hobby.id for hobby in hobbies]
+            if HOBBY_INDEX_ENABLED:
+                matched_profiles = Profile.objects.filter(id__in=hobby_index().with_all(hobby_ids).tolist())
+                any_match_profiles = Profile.objects.filter(id__in=hobby_index().with_any(hobby_ids).tolist())
+            else:
+                matched_profiles = Profile.filter_by_hobbies(hobbies)
+                any_match_profiles = Profile.filter_by_any_hobby(hobbies)
+            matched_profiles = matched_profiles.exclude(user=request.user).select_related('user')
 
             context = {
-                'matched_profiles': matched_profiles,
+                'matched_profiles': matched_profiles.order_by('id')[:PROFILES_ON_MAP_PAGE],
                 'hobbies_form': hobbies_form,
-                'any_match_profiles': any_match_profiles
+                'any_match_profiles': any_match_profiles,
+                # the map markers are loaded for the searched hobbies too
+                'searched_hobbies': hobby_ids,
             }
             return render(request, 'core/map.html', context)
 
 
-def conversations_list(user: User):
-    dialog_msgs = Message.user_msgs(user)
-
-    all_conversations = []
-    used_interlocutors = set()
-    for msg in dialog_msgs:
-        if msg.sender == user:
-            interlocutor = msg.receiver
-        else:
-            interlocutor = msg.sender
+def nearby_profiles(cur_profile, hobbies):
+    ranked = profile_snapshot().nearby(
+        cur_profile.id, cur_profile.latitude, cur_profile.longitude,
+        [hobby.id for hobby in hobbies], NEARBY_PROFILES_ON_MAP,
+    )
+    profiles = Profile.objects.select_related('user').in_bulk([profile_id for profile_id, _, _ in ranked])
 
-        if interlocutor not in used_interlocutors:
-            all_conversations.append(
-                {"object": interlocutor, "date": msg.date_sent}
-            )
-            used_interlocutors.add(interlocutor)
+    nearby = []
+    for profile_id, distance, shared in ranked:
+        if profile_id in profiles:
+            prof = profiles[profile_id]
+            prof.distance_km, prof.shared_hobbies = distance, shared
+            nearby.append(prof)
+    return nearby
 
-    for group in user.inside_group_chats.all():
-        msg = Message.objects.filter(group_chat_in=group).order_by('-date_sent').first()
-        if msg is None:
-            _date = group.date_created
-        else:
-            _date = msg.date_sent
 
-        all_conversations.append(
-            {"object": group, "date": _date}
-        )
-
-    all_conversations.sort(key=lambda o: o["date"], reverse=True)
+@login_required(login_url='login')
+def map_markers(request):
+    """
+    Profiles inside the `south`, `west`, `north`, `east` bounding box of the map sharing
+    a hobby with the user, or having every one of the searched `hobby` ids when given.
+    """
+    try:
+        south, west, north, east = (float(request.GET[side]) for side in ('south', 'west', 'north', 'east'))
+        hobby_ids = [int(hobby_id) for hobby_id in request.GET.getlist('hobby')]
+    except (KeyError, ValueError):
+        return JsonResponse({'error': 'south, west, north and east are required, hobby ids are numbers'}, status=400)
+
+    profiles = Profile.in_viewport(south, west, north, east)
+    if hobby_ids:
+        profiles = profiles.filter(id__in=Profile.filter_by_hobbies(hobby_ids).values('id'))
+    else:
+        profiles = profiles.filter(hobby__in=request.user.profile.hobby.all())
+    profiles = profiles.exclude(user=request.user).distinct().select_related('user')
+    profiles = profiles.order_by('id')[:MAP_MARKERS_LIMIT]
+
+    markers = [{
+        'id': prof.id,
+        'username': prof.user.username,
+        'latitude': prof.latitude,
+        'longitude': prof.longitude,
+        'url': reverse('profile', args=[prof.user_id]),
+    } for prof in profiles]
+    return JsonResponse({'markers': markers, 'truncated': len(markers) == MAP_MARKERS_LIMIT})
+
+
+def conversations_list(request):
+    conversations = Conversation.sidebar(request.user)
+    return paginate(request, conversations, ('-date_last', '-id'), CONVERSATIONS_ON_CHAT_PAGE)
+
+
+def message_history(request, messages):
+    # newest first, so the first page is the latest messages and `next` goes back in time
+    messages = messages.select_related('sender__profile')
+    return CursorPaginator(messages, ('-date_sent', '-id'), MESSAGES_ON_CHAT_PAGE).get_page(request.GET.get('before'))
+
+
+def message_history_json(request, messages):
+    history = message_history(request, messages)
+    return JsonResponse({
+        'messages': [msg.as_dict() for msg in reversed(history.object_list)],
+        'older_msgs_cursor': history.next_cursor,
+    })
+
+
+def release_connections():
+    # nothing is read while waiting, so the connections go back to be reused; the next query reopens them
+    for connection in connections.all():
+        if not connection.in_atomic_block:
+            connection.close()
+
+
+def wait_for_messages(messages, key):
+    deadline = time.monotonic() + LONG_POLL_TIMEOUT
+    while True:
+        seen_version = message_notifier.version(key)
+        new_messages = list(messages[:MESSAGES_ON_CHAT_PAGE])
+        remaining = deadline - time.monotonic()
+        if new_messages or remaining <= 0:
+            return new_messages
+        release_connections()
+        # wake up on a local notification, or re-check for messages saved by other workers
+        message_notifier.wait(key, seen_version, min(remaining, LONG_POLL_INTERVAL))
+
+
+def new_messages_json(request, messages, key):
+    """
+    Long poll: answer with the messages after `?after=<id>` as soon as there are any.
+    Only LONG_POLL_MAX_WAITERS polls are held open at once in a process, the
+    others are answered right away and told to come back after `retry_after` seconds.
+    """
+    try:
+        after = int(request.GET.get('after', 0))
+    except ValueError:
+        after = 0
+    messages = messages.filter(id__gt=after).select_related('sender__profile').order_by('id')
+
+    if long_poll_slots.acquire(blocking=False):
+        try:
+            new_messages = wait_for_messages(messages, key)
+        finally:
+            long_poll_slots.release()
+        retry_after = 0
+    else:
+        new_messages = list(messages[:MESSAGES_ON_CHAT_PAGE])
+        retry_after = LONG_POLL_INTERVAL
 
-    return all_conversations
+    return JsonResponse({
+        'messages': [msg.as_dict() for msg in new_messages],
+        'last_id': new_messages[-1].id if new_messages else after,
+        'retry_after': retry_after,
+    })
 
 
 @login_required(login_url='login')
 def chat_list(request):
-    all_conversations = conversations_list(request.user)
+    all_conversations = conversations_list(request)
 
     context = {
         'all_conversations': all_conversations
@@ -304,21 +426,35 @@ def chat_by_user(request, chat_username):
         Message.objects.create(receiver=chat_user, sender=request.user, msg_text=msg_text)
         return redirect(reverse('chat_by_user', args=[chat_username]))
 
-    cur_user_msgs = Message.user_msgs(request.user)
-    msgs_by_user = cur_user_msgs.filter(Q(sender=chat_user) | Q(receiver=chat_user)).order_by('date_sent')
+    msgs_by_user = message_history(request, Message.dialog_msgs(request.user, chat_user))
 
-    all_conversations = conversations_list(request.user)
+    all_conversations = conversations_list(request)
 
     context = {
         'all_conversations': all_conversations,
         'msg_form': msg_form,
-        'new_all_msgs': msgs_by_user,
+        'new_all_msgs': msgs_by_user.object_list[::-1],
+        'older_msgs_cursor': msgs_by_user.next_cursor,
+        'last_msg_id': msgs_by_user[0].id if msgs_by_user else 0,
         'chat_user': chat_user,
         'chat_username': chat_username,
     }
     return render(request, 'core/chat.html', context)
 
 
+@login_required(login_url='login')
+def chat_by_user_history(request, chat_username):
+    chat_user = get_object_or_404(User, username=chat_username)
+    return message_history_json(request, Message.dialog_msgs(request.user, chat_user))
+
+
+@login_required(login_url='login')
+def chat_by_user_updates(request, chat_username):
+    chat_user = get_object_or_404(User, username=chat_username)
+    messages = Message.dialog_msgs(request.user, chat_user)
+    return new_messages_json(request, messages, dialog_key(request.user.id, chat_user.id))
+
+
 def group_chat_create(request):
     group_chat_form = GroupChatForm(request.POST or None)
 
@@ -337,8 +473,16 @@ def group_chat_create(request):
     return render(request, 'core/create_group_chat.html', context)
 
 
+def member_group_chat_or_404(user, group_chat_id):
+    """The group chat if `user` is in it or created it, anyone else gets a 404 as if it didn't exist."""
+    membership = GroupChat.chat_users.through.objects.filter(groupchat=OuterRef('pk'), user=user)
+    group_chats = GroupChat.objects.annotate(is_member=Exists(membership)).filter(Q(is_member=True) | Q(author=user))
+    return get_object_or_404(group_chats, id=group_chat_id)
+
+
+@login_required(login_url='login')
 def group_chat(request, group_chat_id):
-    group_chat_instance = get_object_or_404(GroupChat, id=group_chat_id)
+    group_chat_instance = member_group_chat_or_404(request.user, group_chat_id)
 
     msg_form = MessageForm(request.POST or None)
     if msg_form.is_valid():
@@ -346,13 +490,15 @@ def group_chat(request, group_chat_id):
         Message.objects.create(sender=request.user, msg_text=msg_text, group_chat_in=group_chat_instance)
         return redirect('group_chat', group_chat_id=group_chat_id)
 
-    group_chat_msgs = group_chat_instance.group_msgs.all().order_by('date_sent')
+    group_chat_msgs = message_history(request, group_chat_instance.group_msgs.all())
 
-    all_conversations = conversations_list(request.user)
+    all_conversations = conversations_list(request)
 
     context = {
         'all_conversations': all_conversations,
-        'group_chat_msgs': group_chat_msgs,
+        'group_chat_msgs': group_chat_msgs.object_list[::-1],
+        'older_msgs_cursor': group_chat_msgs.next_cursor,
+        'last_msg_id': group_chat_msgs[0].id if group_chat_msgs else 0,
         'group_chat_instance': group_chat_instance,
         'group_chat_id': group_chat_id,
         'msg_form': msg_form,
@@ -360,6 +506,61 @@ def group_chat(request, group_chat_id):
     return render(request, 'core/chat.html', context)
 
 
+@login_required(login_url='login')
+def group_chat_history(request, group_chat_id):
+    group_chat_instance = member_group_chat_or_404(request.user, group_chat_id)
+    return message_history_json(request, group_chat_instance.group_msgs.all())
+
+
+@login_required(login_url='login')
+def group_chat_updates(request, group_chat_id):
+    group_chat_instance = member_group_chat_or_404(request.user, group_chat_id)
+    messages = group_chat_instance.group_msgs.all()
+    return new_messages_json(request, messages, group_chat_key(group_chat_instance.id))
+
+
+@staff_member_required
+def cache_stats(request):
+    return JsonResponse(cache.get_stats())
+
+
+def metrics(request):
+    # staff can look at the metrics in a browser, scrapers authenticate with the METRICS_TOKEN bearer token
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    authorized = METRICS_TOKEN and hmac.compare_digest(authorization.encode(), f'Bearer {METRICS_TOKEN}'.encode())
+    if not authorized and not request.user.is_staff:
+        return HttpResponseForbidden()
+    pools = render_pool_metrics(worker_totals.collect('db_pool'), worker_totals.collect('db_pool_gauges'))
+    return HttpResponse(metrics_registry.render(worker_totals.collect('requests')) + pools,
+                        content_type='text/plain; version=0.0.4; charset=utf-8')
+
+
+@staff_member_required
+def profiles_list(request):
+    profiles = []
+    for name in saved_profiles():
+        try:
+            profiles.append(load_summary(name))
+        except FileNotFoundError:
+            # pruned by a request saving a newer profile meanwhile
+            continue
+    context = {
+        'profiles': profiles,
+    }
+    return render(request, 'core/profiles.html', context)
+
+
+@staff_member_required
+def profile_download(request, name, kind):
+    if not PROFILE_NAME.match(name) or kind not in ('prof', 'json'):
+        raise Http404
+    try:
+        profile_file = open(os.path.join(PROFILING_DIR, f'{name}.{kind}'), 'rb')
+    except FileNotFoundError:
+        raise Http404
+    return FileResponse(profile_file, as_attachment=True, filename=f'{name}.{kind}')
+
+
 @login_required(login_url='login')
 def like_post(request, pk):
     post = get_object_or_404(Post, id=pk)